@@ -0,0 +1,339 @@
+"""Offline benchmark for clean_ad_url and expand_short_url against a local redirect farm.
+
+Every scenario runs against HTTP servers on loopback addresses, so no traffic
+leaves the machine and Mongo is replaced by an in-memory collection. Results
+are printed (or written with --output) as JSON so runs on different commits
+can be compared, and --baseline reports the change against an earlier run:
+
+    python benchmark.py --urls 500 --concurrency 50 --output before.json
+    python benchmark.py --urls 500 --concurrency 50 --baseline before.json
+
+The farm listens on 127.0.0.1 to 127.0.0.N (--hosts) so per-host guards see
+several hosts, as they would in production; this needs Linux's 127.0.0.0/8
+loopback.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from aiohttp import web
+from aiohttp.client_proto import ResponseHandler
+
+# The bot connects at import time; keep it off the database configured in .env
+os.environ['MONGODB_URI'] = 'mongomock://'
+import bot
+from fake_telegram import percentile
+
+REALISTIC_URLS = [
+    'https://www.amazon.in/dp/B0CX23V2ZK/ref=sr_1_3?crid=2M1&keywords=earbuds&qid=1712&sprefix=earb&sr=8-3&tag=deals-21&linkCode=ll1',
+    'https://www.flipkart.com/item/p/itm123?pid=MOB123&lid=LST123&marketplace=FLIPKART&affid=aff1&affExtParam1=x&otracker=search',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=AbCdEf&feature=share&pp=ygU',
+    'https://www.instagram.com/p/C1a2b3/?igsh=MTc4&img_index=2&utm_source=ig_web_copy_link',
+    'https://www.facebook.com/groups/deals/posts/123/?mibextid=Nif5oz&__tn__=R&fbclid=IwAR0abc',
+    'https://twitter.com/someone/status/1789?s=20&t=abcDEF&ref_src=twsrc',
+    'https://www.google.com/url?sa=t&url=https%3A%2F%2Fshop.example.com%2Fsale%3Futm_source%3Dgoogle%26id%3D7&ved=2ah',
+    'https://l.facebook.com/l.php?u=https%3A%2F%2Fnews.example.org%2Fstory%3Ffbclid%3Dx%26page%3D2&h=AT0',
+    'https://www.linkedin.com/posts/someone_activity-123?utm_source=share&trk=public_post&lipi=urn',
+    'https://shop.example.com/product/42?utm_source=newsletter&utm_medium=email&utm_campaign=spring&gclid=Cj0&color=red',
+    'https://blog.example.org/post?id=9&mc_cid=abc&mc_eid=def&_hsenc=p2A&_hsmi=12',
+    'https://example.net/search?q=shoes&page=3&sort=price'
+]
+
+SCENARIOS = ['strip', 'clean_offline', 'redirect_301', 'redirect_302', 'meta_refresh',
+             'slow_host', 'redirect_loop', 'large_body', 'cache_hit']
+
+class MemoryCollection:
+    """Just enough of a pymongo collection to back the expansion cache in memory"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def find_one(self, query):
+        return self.docs.get(query.get('_id'))
+
+    def replace_one(self, query, doc, upsert=False):
+        self.docs[query['_id']] = doc
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+class RedirectFarm:
+    """Loopback HTTP servers serving configurable redirect chains and counting requests"""
+
+    def __init__(self, hosts=4, port=8090, hops=3, slow_ms=200, body_kb=512):
+        self.addresses = [f'127.0.0.{i}' for i in range(1, hosts + 1)]
+        self.port = port
+        self.hops = hops
+        self.slow_ms = slow_ms
+        self.body_kb = body_kb
+        self.requests = 0
+        self._runner = None
+
+    def url(self, i, path):
+        return f'http://{self.addresses[i % len(self.addresses)]}:{self.port}{path}'
+
+    def destination(self, request, i):
+        host = self.addresses[(int(i) + 1) % len(self.addresses)]
+        return f'http://{host}:{self.port}/dest/{i}?utm_source=bench&utm_medium=redirect&tag=aff-21&id={i}'
+
+    async def _redirect(self, request):
+        self.requests += 1
+        status, hops, i = (int(request.match_info[k]) for k in ('status', 'hops', 'i'))
+        if hops <= 1:
+            location = self.destination(request, i)
+        else:
+            location = f'/r/{status}/{hops - 1}/{i}'
+        return web.Response(status=status, headers={'Location': location})
+
+    async def _meta(self, request):
+        self.requests += 1
+        hops, i = int(request.match_info['hops']), request.match_info['i']
+        target = self.destination(request, i) if hops <= 1 else f'/meta/{hops - 1}/{i}'
+        return web.Response(
+            text=f'<html><head><meta http-equiv="refresh" content="0;url={target}"></head><body>Redirecting</body></html>',
+            content_type='text/html'
+        )
+
+    async def _slow(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.slow_ms / 1000)
+        return web.Response(status=302, headers={'Location': self.destination(request, request.match_info['i'])})
+
+    async def _loop(self, request):
+        self.requests += 1
+        other = 'b' if request.match_info['side'] == 'a' else 'a'
+        return web.Response(status=302, headers={'Location': f"/loop/{other}/{request.match_info['i']}"})
+
+    async def _large(self, request):
+        self.requests += 1
+        # The redirect sits at the top; the padding is what a prefix read should never fetch
+        head = (
+            f'<html><head><meta http-equiv="refresh" content="0;url={self.destination(request, request.match_info["i"])}">'
+            '</head><body>'
+        )
+        return web.Response(text=head + 'x' * (self.body_kb * 1024) + '</body></html>', content_type='text/html')
+
+    async def _destination(self, request):
+        self.requests += 1
+        return web.Response(text='<html><body>Landing page</body></html>', content_type='text/html')
+
+    async def start(self):
+        server = web.Application()
+        server.router.add_get('/r/{status}/{hops}/{i}', self._redirect)
+        server.router.add_get('/meta/{hops}/{i}', self._meta)
+        server.router.add_get('/slow/{i}', self._slow)
+        server.router.add_get('/loop/{side}/{i}', self._loop)
+        server.router.add_get('/big/{i}', self._large)
+        server.router.add_get('/dest/{i}', self._destination)
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        for address in self.addresses:
+            await web.TCPSite(self._runner, address, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+def scenario_urls(name, farm, count, run):
+    """URLs for one scenario; run keeps them unique between passes so nothing is served from cache"""
+    if name in ('strip', 'clean_offline'):
+        return [f'{REALISTIC_URLS[i % len(REALISTIC_URLS)]}&n={run}-{i}' for i in range(count)]
+    paths = {
+        'redirect_301': lambda i: f'/r/301/{farm.hops}/{i}',
+        'redirect_302': lambda i: f'/r/302/{farm.hops}/{i}',
+        'meta_refresh': lambda i: f'/meta/{farm.hops}/{i}',
+        'slow_host': lambda i: f'/slow/{i}',
+        'redirect_loop': lambda i: f'/loop/a/{i}',
+        'large_body': lambda i: f'/big/{i}',
+        'cache_hit': lambda i: f'/r/301/{farm.hops}/{i}'
+    }
+    return [f'{farm.url(i, paths[name](i))}?n={run}-{i}' for i in range(count)]
+
+def reset_pipeline():
+    """Fresh cache, guards and scheduler so scenarios don't leak state into each other"""
+    bot.expansion_cache = bot.ExpansionCache(MemoryCollection())
+    bot.host_guards = bot.HostGuards()
+    bot.expansion_scheduler = bot.ExpansionScheduler()
+    bot.expansion_flight = bot.SingleFlight()
+
+async def run_urls(name, urls, concurrency, priority):
+    """Clean every URL with bounded concurrency and return (per-URL latencies in ms, results)"""
+    if name == 'strip':
+        latencies = []
+        results = []
+        for url in urls:
+            started = time.perf_counter()
+            results.append(bot.strip_tracking_params(url))
+            latencies.append((time.perf_counter() - started) * 1000)
+        return latencies, results
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def clean(url):
+        async with semaphore:
+            started = time.perf_counter()
+            result = await bot.clean_ad_url(url, priority)
+            latencies.append((time.perf_counter() - started) * 1000)
+            return result
+
+    results = await asyncio.gather(*(clean(url) for url in urls))
+    return latencies, results
+
+async def run_scenario(name, farm, traffic, count, concurrency, priority):
+    reset_pipeline()
+    if name == 'cache_hit':
+        # Warm the cache with the same URLs the timed pass will ask for
+        await run_urls(name, scenario_urls(name, farm, count, 0), concurrency, priority)
+    urls = scenario_urls(name, farm, count, 0)
+
+    gc.collect()
+    requests_before, bytes_before = farm.requests, traffic['bytes']
+    started = time.perf_counter()
+    latencies, results = await run_urls(name, urls, concurrency, priority)
+    elapsed = time.perf_counter() - started
+    requests, downloaded = farm.requests - requests_before, traffic['bytes'] - bytes_before
+
+    # Allocation pass on fresh URLs; tracemalloc slows everything down, so it isn't timed
+    if name == 'cache_hit':
+        alloc_urls = urls
+    else:
+        reset_pipeline()
+        alloc_urls = scenario_urls(name, farm, count, 1)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    await run_urls(name, alloc_urls, concurrency, priority)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+
+    failed = sum(1 for result in results if 'could not expand' in result)
+    expansions = 0 if name in ('strip', 'clean_offline', 'cache_hit') else count
+    return {
+        'urls': count,
+        'concurrency': 1 if name == 'strip' else concurrency,
+        'elapsed_s': elapsed,
+        'throughput_per_s': count / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        },
+        'unexpanded': failed,
+        'http_requests_per_url': requests / count if count else 0.0,
+        'bytes_downloaded_per_expansion': downloaded / expansions if expansions else 0.0,
+        'alloc': {
+            'net_blocks_per_url': sum(stat.count_diff for stat in diff) / count if count else 0.0,
+            'net_bytes_per_url': sum(stat.size_diff for stat in diff) / count if count else 0.0,
+            'peak_bytes': peak
+        }
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(result, baseline):
+    """Relative change (new - old) / old of the headline numbers per scenario"""
+    changes = {}
+    for name, current in result['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        def change(new, old):
+            return (new - old) / old if old else None
+        changes[name] = {
+            'throughput': change(current['throughput_per_s'], previous['throughput_per_s']),
+            'p95_ms': change(current['latency_ms']['p95'], previous['latency_ms']['p95']),
+            'p99_ms': change(current['latency_ms']['p99'], previous['latency_ms']['p99']),
+            'net_bytes_per_url': change(current['alloc']['net_bytes_per_url'], previous['alloc']['net_bytes_per_url'])
+        }
+    return changes
+
+async def run_benchmark(scenarios, count, concurrency, priority, hosts, port, hops, slow_ms, body_kb):
+    farm = RedirectFarm(hosts=hosts, port=port, hops=hops, slow_ms=slow_ms, body_kb=body_kb)
+    await farm.start()
+    bot.SHORTENER_HOSTS.update(farm.addresses)
+
+    # Count bytes as they come off the socket, headers included, whatever the caller reads
+    traffic = {'bytes': 0}
+    data_received = ResponseHandler.data_received
+    def counting_data_received(protocol, data):
+        traffic['bytes'] += len(data)
+        data_received(protocol, data)
+    ResponseHandler.data_received = counting_data_received
+
+    try:
+        results = {}
+        for name in scenarios:
+            results[name] = await run_scenario(name, farm, traffic, count, concurrency, priority)
+    finally:
+        ResponseHandler.data_received = data_received
+        await bot.close_http_session()
+        await farm.stop()
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'config': {
+            'urls': count, 'concurrency': concurrency, 'priority': priority, 'hosts': hosts,
+            'hops': hops, 'slow_ms': slow_ms, 'body_kb': body_kb,
+            'expand_timeout': bot.EXPAND_TIMEOUT, 'sniff_bytes': bot.SNIFF_BYTES,
+            'host_concurrency': bot.HOST_CONCURRENCY
+        },
+        'scenarios': results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--urls', type=int, default=300, help='URLs per scenario')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--priority', default='premium', choices=sorted(bot.EXPANSION_CLASSES))
+    parser.add_argument('--hosts', type=int, default=4, help='loopback addresses the farm listens on')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--hops', type=int, default=3, help='redirects before the destination')
+    parser.add_argument('--slow-ms', type=int, default=200, help='response delay of the slow host')
+    parser.add_argument('--body-kb', type=int, default=512, help='padding after the redirect on large pages')
+    parser.add_argument('--output', help='write the JSON result to this file')
+    parser.add_argument('--baseline', help='earlier JSON result to compare against')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    logging.getLogger('bot').setLevel(logging.WARNING)
+
+    result = asyncio.run(run_benchmark(
+        scenarios, args.urls, args.concurrency, args.priority,
+        args.hosts, args.port, args.hops, args.slow_ms, args.body_kb
+    ))
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['change_vs_baseline'] = compare(result, json.load(f))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,40 @@
 import os
+import re
+import hmac
+import secrets
+import hashlib
+import bisect
+import functools
+import threading
+import csv
+import itertools
+import tempfile
+import signal
+import html
+import json
+import time
+import sys
+import heapq
+import asyncio
 import logging
-import requests
-from urllib.parse import urlparse, parse_qs, urlunparse
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler
-from pymongo import MongoClient
+import aiohttp
+from aiohttp import web
+from urllib.parse import urlparse, urlunparse, urlsplit, urlunsplit, urljoin, unquote, unquote_plus
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity,
+    InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton
+)
+from telegram.error import RetryAfter, Forbidden, TelegramError
+from telegram.ext import (
+    Application, CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler,
+    InlineQueryHandler, ChosenInlineResultHandler, BaseUpdateProcessor, filters
+)
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from collections import OrderedDict, Counter, deque
 
 # Load environment variables
 load_dotenv()
@@ -35,139 +63,2315 @@ logger = logging.getLogger(__name__)
 
 # Environment variables
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', 8080))
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 32))
 MONGODB_URI = os.getenv('MONGODB_URI')
 DB_NAME = os.getenv('DB_NAME', 'AdsCleaner')
 COLLECTION = os.getenv('COLLECTION', 'users')
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_ID', '').split(',') if id.strip()]
 FREE_DAILY_LIMIT = int(os.getenv('FREE_DAILY_LIMIT', 4))
+MAX_URLS_PER_MESSAGE = int(os.getenv('MAX_URLS_PER_MESSAGE', 20))
+MESSAGE_URL_CONCURRENCY = int(os.getenv('MESSAGE_URL_CONCURRENCY', 5))
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+URL_DISPLAY_LIMIT = 3500
+INLINE_MAX_URLS = int(os.getenv('INLINE_MAX_URLS', 5))
+INLINE_EXPAND_WAIT = float(os.getenv('INLINE_EXPAND_WAIT', 0.08))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+INLINE_PENDING_CACHE_TIME = int(os.getenv('INLINE_PENDING_CACHE_TIME', 5))
+BULK_MAX_FILE_SIZE = int(os.getenv('BULK_MAX_FILE_SIZE', 5 * 1024 * 1024))
+BULK_MAX_LINES = int(os.getenv('BULK_MAX_LINES', 50000))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', 16))
+BULK_PROGRESS_INTERVAL = float(os.getenv('BULK_PROGRESS_INTERVAL', 5))
 REFERRALS_PER_REWARD = int(os.getenv('REFERRALS_PER_REWARD', 10))
 PREMIUM_DAYS_PER_REWARD = int(os.getenv('PREMIUM_DAYS_PER_REWARD', 1))
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', 2.0))
+COUNTER_FLUSH_OPS = int(os.getenv('COUNTER_FLUSH_OPS', 500))
+QUOTA_COLLECTION = os.getenv('QUOTA_COLLECTION', 'usage_buckets')
+QUOTA_RETENTION_DAYS = int(os.getenv('QUOTA_RETENTION_DAYS', 2))
+BROADCAST_COLLECTION = os.getenv('BROADCAST_COLLECTION', 'broadcasts')
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+REFERRALS_COLLECTION = os.getenv('REFERRALS_COLLECTION', 'referrals')
+METRICS_COLLECTION = os.getenv('METRICS_COLLECTION', 'metrics')
+METRICS_RECONCILE_INTERVAL = float(os.getenv('METRICS_RECONCILE_INTERVAL', 3600))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
 FACEBOOK_PAGE = os.getenv('FACEBOOK_PAGE', 'https://www.facebook.com/yourpage')
 UPI_ID = os.getenv('UPI_ID', 'yourupi@id')
+EXPAND_TIMEOUT = float(os.getenv('EXPAND_TIMEOUT', 5))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', 300))
+EXPANSION_WORKERS = int(os.getenv('EXPANSION_WORKERS', 64))
+# Per priority class: (weight, max concurrent expansions)
+EXPANSION_CLASSES = {
+    'admin': (8, EXPANSION_WORKERS),
+    'premium': (4, int(os.getenv('PREMIUM_EXPANSION_LIMIT', 48))),
+    'free': (1, int(os.getenv('FREE_EXPANSION_LIMIT', 32))),
+    'bulk': (1, int(os.getenv('BULK_EXPANSION_LIMIT', 16)))
+}
+FREE_QUEUE_LIMIT = int(os.getenv('FREE_QUEUE_LIMIT', 200))
+HOST_CONCURRENCY = int(os.getenv('HOST_CONCURRENCY', 8))
+HOST_RESERVED_SLOTS = int(os.getenv('HOST_RESERVED_SLOTS', 2))
+HOST_TIMEOUT_MIN = float(os.getenv('HOST_TIMEOUT_MIN', 1.0))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 60))
+MAX_REDIRECT_HOPS = int(os.getenv('MAX_REDIRECT_HOPS', 10))
+SNIFF_BYTES = int(os.getenv('SNIFF_BYTES', 8192))
+TRACKING_RULES_FILE = os.getenv(
+    'TRACKING_RULES_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tracking_rules.json')
+)
+RULES_RELOAD_INTERVAL = float(os.getenv('RULES_RELOAD_INTERVAL', 30))
+REDIRECT_PATH_PATTERNS = [
+    p.strip() for p in os.getenv(
+        'REDIRECT_PATH_PATTERNS',
+        '/redirect?url=,/l.php?u=,/url?q=,/out?url=,/away?to=,/go?url='
+    ).split(',') if p.strip()
+]
+URL_CACHE_COLLECTION = os.getenv('URL_CACHE_COLLECTION', 'url_cache')
+URL_CACHE_SIZE = int(os.getenv('URL_CACHE_SIZE', 10000))
+URL_CACHE_TTL = int(os.getenv('URL_CACHE_TTL', 86400))
+URL_CACHE_NEGATIVE_TTL = int(os.getenv('URL_CACHE_NEGATIVE_TTL', 300))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.005))
+PROFILER_MAX_SECONDS = int(os.getenv('PROFILER_MAX_SECONDS', 300))
+
+# ==================== INSTRUMENTATION ====================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Histogram:
+    """Prometheus-style latency histogram; safe to observe from worker threads"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labels + ('le',), label_values + (le,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {series[-2]}')
+            lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+class MetricCounter:
+    """Prometheus-style monotonically increasing counter"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+class MetricsRegistry:
+    """Holds metrics plus collectors that report existing stats as gauges at scrape time"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        metric = MetricCounter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register func() -> [(name, help, labels dict, value)] to be read on every scrape"""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        described = set()
+        for collect in self.collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.error(f"Error collecting metrics from {collect.__name__}: {e}")
+                continue
+            for name, help_text, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} gauge'])
+                lines.append(f'{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', 'Time spent in each update handler', ('handler',))
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Exceptions escaping update handlers', ('handler',))
+EXPANSION_SECONDS = metrics.histogram(
+    'bot_expansion_seconds', 'Network expansion time by shortener host and outcome', ('host', 'outcome'))
+MONGO_SECONDS = metrics.histogram('bot_mongo_seconds', 'Mongo operation latency', ('collection', 'operation'))
+LOOP_LAG_SECONDS = metrics.histogram('bot_event_loop_lag_seconds', 'How late the event loop woke a periodic timer')
+
+def timed(handler):
+    """Wrap a handler so its latency and escaping errors are recorded under its name"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class TimedCollection:
+    """Collection proxy that records the latency of every operation in MONGO_SECONDS"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._name = getattr(collection, 'name', 'unknown')
+
+    def __getattr__(self, operation):
+        attr = getattr(self._collection, operation)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                MONGO_SECONDS.observe(time.perf_counter() - started, self._name, operation)
+                raise
+            if operation in ('find', 'aggregate'):
+                # Cursors do their round trips while being iterated, so time that too
+                return self._timed_cursor(result, operation, started)
+            MONGO_SECONDS.observe(time.perf_counter() - started, self._name, operation)
+            return result
+        return call
+
+    def _timed_cursor(self, cursor, operation, started):
+        try:
+            yield from cursor
+        finally:
+            MONGO_SECONDS.observe(time.perf_counter() - started, self._name, operation)
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a timer, a direct read on blocking code"""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            LOOP_LAG_SECONDS.observe(self.last_lag)
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a side thread and counts folded stacks"""
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.started_at = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+        self.samples = Counter()
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        target = threading.get_ident()
+        self._thread = threading.Thread(target=self._sample, args=(target,), name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Stop sampling and return the folded stacks collected"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.samples
+
+    def _sample(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    @staticmethod
+    def folded(samples):
+        """Folded-stack text, the input format of flamegraph.pl and speedscope"""
+        return ''.join(f'{stack} {count}\n' for stack, count in samples.most_common())
+
+    @staticmethod
+    def top_functions(samples, limit=10):
+        """Functions most often on top of the stack, as (function, share of samples)"""
+        leaves = Counter()
+        for stack, count in samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(name, count / total) for name, count in leaves.most_common(limit)]
+
+loop_lag = LoopLagMonitor()
+profiler = SamplingProfiler()
+# =========================================================
 
 # Initialize MongoDB
 try:
-    client = MongoClient(MONGODB_URI)
+    if MONGODB_URI and MONGODB_URI.startswith('mongomock://'):
+        # In-memory stand-in for local runs and load tests (pip install mongomock)
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = MongoClient(MONGODB_URI)
     db = client[DB_NAME]
-    users_collection = db[COLLECTION]
+    users_collection = TimedCollection(db[COLLECTION])
+    url_cache_collection = TimedCollection(db[URL_CACHE_COLLECTION])
+    quota_collection = TimedCollection(db[QUOTA_COLLECTION])
+    broadcast_collection = TimedCollection(db[BROADCAST_COLLECTION])
+    metrics_collection = TimedCollection(db[METRICS_COLLECTION])
+    referrals_collection = TimedCollection(db[REFERRALS_COLLECTION])
     logger.info("Connected to MongoDB successfully")
 except Exception as e:
     logger.error(f"Error connecting to MongoDB: {e}")
     class DummyCollection:
         def find_one(self, *args, **kwargs): return None
         def update_one(self, *args, **kwargs): return None
+        def update_many(self, *args, **kwargs): return None
         def insert_one(self, *args, **kwargs): return None
+        def insert_many(self, *args, **kwargs): return None
         def find(self, *args, **kwargs): return []
         def count_documents(self, *args, **kwargs): return 0
+        def aggregate(self, *args, **kwargs): return []
+        def replace_one(self, *args, **kwargs): return None
+        def find_one_and_update(self, *args, **kwargs): return None
+        def bulk_write(self, *args, **kwargs): return None
+        def create_index(self, *args, **kwargs): return None
+        def index_information(self): return {}
     users_collection = DummyCollection()
+    url_cache_collection = DummyCollection()
+    quota_collection = DummyCollection()
+    broadcast_collection = DummyCollection()
+    metrics_collection = DummyCollection()
+    referrals_collection = DummyCollection()
 
 def is_admin(user_id):
     """Check if user is admin"""
     return user_id in ADMIN_IDS
 
-def expand_short_url(short_url):
-    """Expand short URLs to see their final destination with multiple methods"""
-    try:
-        # Method 1: HEAD request (fastest)
+# ==================== HTTP SESSION ====================
+USER_AGENT = 'Mozilla/5.0 (Ads-Cleaner-Bot)'
+_http_session = None
+
+async def get_http_session():
+    """Return the shared keep-alive session, creating it on first use"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            use_dns_cache=True,
+            keepalive_timeout=30
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': USER_AGENT}
+        )
+    return _http_session
+
+async def close_http_session(application=None):
+    """Close the shared session on shutdown"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+# ======================================================
+
+# ==================== HOST CLASSIFIER ====================
+def _compile_redirect_patterns(patterns):
+    """Turn '/path?param=' strings into (path, param) pairs"""
+    compiled = []
+    for pattern in patterns:
+        path, _, param = pattern.partition('?')
+        compiled.append((path.rstrip('/').lower(), param.rstrip('=').lower()))
+    return compiled
+
+_redirect_patterns = _compile_redirect_patterns(REDIRECT_PATH_PATTERNS)
+
+def shortener_domain(host):
+    """The SHORTENER_HOSTS entry matching a host or one of its parent domains, or None"""
+    host = host.lower().rsplit('@', 1)[-1].split(':', 1)[0].rstrip('.')
+    labels = host.split('.')
+    for i in range(len(labels) - 1):
+        domain = '.'.join(labels[i:])
+        if domain in SHORTENER_HOSTS:
+            return domain
+    return None
+
+def is_shortener_host(host):
+    """Match a host or any of its parent domains against SHORTENER_HOSTS"""
+    return shortener_domain(host) is not None
+
+def needs_expansion(url):
+    """Decide up front whether a URL needs a network round trip"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https'):
+        return False
+    if is_shortener_host(parsed.netloc):
+        return True
+    if parsed.query and _redirect_patterns:
+        path = parsed.path.rstrip('/').lower()
+        query = '&' + parsed.query.lower()
+        for pattern_path, param in _redirect_patterns:
+            if path.endswith(pattern_path) and f'&{param}=' in query:
+                return True
+    return False
+# =========================================================
+
+# ==================== TRACKING RULES ====================
+_REGEX_META = set('\\.^$*+?{}[]|()')
+_TRIE_RULES = object()
+
+def _literal_prefix(pattern):
+    """Return (prefix, is_literal) for a parameter-name regex"""
+    if '|' in pattern:
+        return '', False
+    prefix = []
+    for ch in pattern:
+        if ch in _REGEX_META:
+            # A quantifier makes the preceding character optional
+            if ch in '*?{' and prefix:
+                prefix.pop()
+            return ''.join(prefix), False
+        prefix.append(ch)
+    return pattern, True
+
+# Host part of a ClearURLs urlPattern: literal domains, optionally with any TLD
+_HOST_LITERAL = r'[a-z0-9-]+(?:\\\.[a-z0-9-]+)*'
+_URL_PATTERN_HOST = re.compile(
+    r'\^?https\?:(?:\\?/){2}'
+    r'(?:\(\?:\[a-z0-9-\]\+\\\.\)\*\??)?'
+    rf'(?:(?P<host>{_HOST_LITERAL})|\(\?:(?P<hosts>{_HOST_LITERAL}(?:\|{_HOST_LITERAL})*)\))'
+    r'(?P<tld>\(\?:\\\.\[a-z\]\{2,\}\)(?:\{1,\}|\+))?'
+    r'(?=$|\\?/|\$|\(\?:\\?/|\(\?:\[/?#|\[/?#)'
+)
+BLOCKED_URL_TEXT = "❌ Blocked (tracking-only link)"
+
+def _pattern_hosts(pattern):
+    """(domains, labels) a urlPattern can only match, or None if it can't be indexed.
+
+    Labels come from patterns that accept any TLD, such as google(?:\\.[a-z]{2,}){1,}.
+    """
+    match = _URL_PATTERN_HOST.match(pattern)
+    if not match:
+        return None
+    hosts = [h.replace('\\.', '.').lower() for h in (match.group('host') or match.group('hosts')).split('|')]
+    if match.group('tld'):
+        return [], [host.split('.')[0] for host in hosts]
+    return hosts, []
+
+class TrackingRuleProvider:
+    """One compiled ClearURLs provider: exact keys, a prefix trie and path rules"""
+
+    def __init__(self, name, spec):
+        self.name = name
+        # Extra hosts on top of urlPattern, e.g. a site's own short domain
+        self.domains = {d.lower() for d in spec.get('domains', [])}
+        if 'urlPattern' not in spec and self.domains:
+            # Domains alone: never match by pattern, and nothing more to index
+            self.url_pattern = re.compile('(?!)')
+            self.pattern_hosts = ([], [])
+        else:
+            self.url_pattern = re.compile(spec.get('urlPattern', '.*'), re.IGNORECASE)
+            # Index by the hosts the pattern names; the pattern is still checked
+            self.pattern_hosts = _pattern_hosts(spec.get('urlPattern', '.*'))
+        self.complete = spec.get('completeProvider', False)
+        self.exact = set()
+        self.trie = {}
+        self.fallback = []
+        for rule in spec.get('rules', []) + spec.get('referralMarketing', []):
+            prefix, is_literal = _literal_prefix(rule)
+            if is_literal:
+                self.exact.add(rule.lower())
+                continue
+            regex = re.compile(rule, re.IGNORECASE)
+            if not prefix:
+                self.fallback.append(regex)
+                continue
+            node = self.trie
+            for ch in prefix.lower():
+                node = node.setdefault(ch, {})
+            node.setdefault(_TRIE_RULES, []).append(regex)
+        self.raw_rules = [re.compile(r, re.IGNORECASE) for r in spec.get('rawRules', [])]
+        self.exceptions = [re.compile(r, re.IGNORECASE) for r in spec.get('exceptions', [])]
+        self.redirections = [re.compile(r, re.IGNORECASE) for r in spec.get('redirections', [])]
+
+    def applies_to(self, url, suffixes):
+        if self.domains.isdisjoint(suffixes) and not self.url_pattern.match(url):
+            return False
+        return not any(e.match(url) for e in self.exceptions)
+
+    def is_tracking(self, key):
+        key = key.lower()
+        if key in self.exact:
+            return True
+        node = self.trie
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                break
+            for regex in node.get(_TRIE_RULES, ()):
+                if regex.fullmatch(key):
+                    return True
+        return any(regex.fullmatch(key) for regex in self.fallback)
+
+class TrackingRuleEngine:
+    """Host-suffix index over compiled providers, reloaded when the rule file changes"""
+
+    def __init__(self, path, reload_interval=RULES_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked_at = 0.0
+        self._by_domain = {}
+        self._by_label = {}
+        self._generic = []
+        self.load()
+
+    def load(self):
+        """Compile the rule file, keeping the previous rules if it is broken"""
         try:
-            response = requests.head(short_url, allow_redirects=True, timeout=5, 
-                                   headers={'User-Agent': 'Mozilla/5.0 (Ads-Cleaner-Bot)'})
-            if response.url != short_url:
-                return response.url
-        except:
-            pass
-        
-        # Method 2: GET request (slower but more reliable)
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                providers = json.load(f)['providers']
+        except FileNotFoundError:
+            mtime = None
+            providers = {'globalRules': {'urlPattern': '.*', 'rules': sorted(TRACKING_PARAMS)}}
+        except Exception as e:
+            logger.error(f"Error loading tracking rules: {e}")
+            return False
+
+        by_domain = {}
+        by_label = {}
+        generic = []
+        for name, spec in providers.items():
+            try:
+                provider = TrackingRuleProvider(name, spec)
+            except re.error as e:
+                logger.error(f"Skipping tracking rule provider {name}: {e}")
+                continue
+            for domain in provider.domains:
+                by_domain.setdefault(domain, []).append(provider)
+            if provider.pattern_hosts:
+                domains, labels = provider.pattern_hosts
+                for domain in domains:
+                    by_domain.setdefault(domain, []).append(provider)
+                for label in labels:
+                    by_label.setdefault(label, []).append(provider)
+            else:
+                generic.append(provider)
+
+        self._by_domain, self._by_label, self._generic = by_domain, by_label, generic
+        self._mtime = mtime
+        logger.info(f"Loaded {len(providers)} tracking rule providers")
+        return True
+
+    def maybe_reload(self):
+        """Pick up edits to the rule file without a restart"""
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def providers_for(self, url, host):
+        """Providers whose domain is a suffix of host, plus matching generic ones"""
+        providers = []
+        labels = host.lower().rsplit('@', 1)[-1].split(':', 1)[0].rstrip('.').split('.')
+        suffixes = ['.'.join(labels[i:]) for i in range(len(labels) - 1)]
+        for suffix in suffixes:
+            providers.extend(self._by_domain.get(suffix, ()))
+        for label in dict.fromkeys(labels):
+            providers.extend(self._by_label.get(label, ()))
+        providers.extend(self._generic)
+        # A provider can be reached through both its domains and its pattern
+        return [p for p in dict.fromkeys(providers) if p.applies_to(url, suffixes)]
+
+    def unwrap(self, url):
+        """Follow destination URLs embedded in redirect parameters, without the network"""
+        for _ in range(MAX_REDIRECT_HOPS):
+            target = self._embedded_target(url)
+            if not target or target == url:
+                break
+            url = target
+        return url
+
+    def _embedded_target(self, url):
+        self.maybe_reload()
+        parsed = urlparse(url)
+        for provider in self.providers_for(url, parsed.netloc):
+            for redirection in provider.redirections:
+                match = redirection.match(url)
+                if match:
+                    return unquote(match.group(1))
+        if not parsed.query:
+            return None
+        path = parsed.path.rstrip('/').lower()
+        for pattern_path, param in _redirect_patterns:
+            if not path.endswith(pattern_path):
+                continue
+            for segment in parsed.query.split('&'):
+                key, _, value = segment.partition('=')
+                if key.lower() == param:
+                    value = unquote(value)
+                    if value.startswith(('http://', 'https://')):
+                        return value
+        return None
+
+tracking_rules = TrackingRuleEngine(TRACKING_RULES_FILE)
+# ========================================================
+
+# ==================== URL CACHE ====================
+def normalize_cache_key(url):
+    """Normalize a short URL so equivalent links share a cache entry"""
+    parsed = urlparse(url.strip())
+    return urlunparse((
+        parsed.scheme.lower(),
+        parsed.netloc.lower(),
+        parsed.path or '/',
+        parsed.params,
+        parsed.query,
+        ''
+    ))
+
+class ExpansionCache:
+    """Bounded in-memory LRU with TTL, backed by a Mongo collection"""
+
+    def __init__(self, collection, max_size=URL_CACHE_SIZE,
+                 ttl=URL_CACHE_TTL, negative_ttl=URL_CACHE_NEGATIVE_TTL):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_local(self, key):
+        """Return a cached expansion from memory, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def get(self, key):
+        """Look up memory first, then the persistent tier"""
+        value = self.get_local(key)
+        if value is not None:
+            return value
         try:
-            response = requests.get(short_url, allow_redirects=True, timeout=5,
-                                  headers={'User-Agent': 'Mozilla/5.0 (Ads-Cleaner-Bot)'})
-            if response.url != short_url:
-                return response.url
-        except:
-            pass
+            doc = await asyncio.to_thread(self.collection.find_one, {'_id': key})
+        except Exception as e:
+            logger.error(f"Error reading URL cache: {e}")
+            doc = None
+        if doc and doc.get('expires_at') and doc['expires_at'] > datetime.utcnow():
+            self.persistent_hits += 1
+            expires_at = time.time() + (doc['expires_at'] - datetime.utcnow()).total_seconds()
+            self._remember(key, doc['value'], expires_at)
+            return doc['value']
+        self.misses += 1
+        return None
+
+    async def set(self, key, value, negative=False):
+        """Store an expansion; failed ones use the short negative TTL"""
+        ttl = self.negative_ttl if negative else self.ttl
+        self._remember(key, value, time.time() + ttl)
+        try:
+            await asyncio.to_thread(
+                self.collection.replace_one,
+                {'_id': key},
+                {'_id': key, 'value': value, 'negative': negative,
+                 'expires_at': datetime.utcnow() + timedelta(seconds=ttl)},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error writing URL cache: {e}")
+
+    def ensure_indexes(self):
+        """Let Mongo expire persistent entries on its own"""
+        try:
+            self.collection.create_index('expires_at', expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Error creating URL cache index: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.hits + self.persistent_hits) / lookups if lookups else 0.0
+        }
+
+expansion_cache = ExpansionCache(url_cache_collection)
+# ===================================================
+
+# ==================== EXPANSION SCHEDULER ====================
+class ExpansionOverloaded(Exception):
+    """Raised when free-tier expansion work is shed under load"""
+
+class ExpansionScheduler:
+    """Weighted-fair scheduler for network expansions with per-class concurrency limits"""
+
+    def __init__(self, workers=EXPANSION_WORKERS, classes=EXPANSION_CLASSES,
+                 free_queue_limit=FREE_QUEUE_LIMIT):
+        self.workers = workers
+        self.free_queue_limit = free_queue_limit
+        self.active = 0
+        self._vtime = 0.0
+        # Queued jobs by key, so a more urgent caller of the same key can promote them
+        self._queued = {}
+        # Classes are listed most urgent first; rank orders them for promotion
+        self._classes = {
+            name: {
+                'rank': rank, 'weight': weight, 'limit': limit, 'queue': deque(), 'active': 0,
+                'pass': 0.0, 'completed': 0, 'shed': 0, 'wait_total': 0.0, 'promoted': 0
+            }
+            for rank, (name, (weight, limit)) in enumerate(classes.items())
+        }
+
+    async def submit(self, priority, factory, key=None):
+        """Run factory() when its class's turn comes and return its result"""
+        cls = self._classes.get(priority, self._classes['free'])
+        if cls is self._classes['free'] and len(cls['queue']) >= self.free_queue_limit:
+            cls['shed'] += 1
+            raise ExpansionOverloaded()
+        future = asyncio.get_running_loop().create_future()
+        job = (factory, future, time.monotonic(), key)
+        self._enqueue(cls, job)
+        if key is not None:
+            self._queued[key] = (cls, job)
+        self._dispatch()
+        return await future
+
+    def _enqueue(self, cls, job):
+        if not cls['queue']:
+            # A class that was idle joins at the current virtual time instead of banking credit
+            cls['pass'] = max(cls['pass'], self._vtime)
+        cls['queue'].append(job)
+
+    def promote(self, key, priority):
+        """Move a still-queued job for key up to priority if that class is more urgent"""
+        queued = self._queued.get(key)
+        target = self._classes.get(priority, self._classes['free'])
+        if queued is None or target['rank'] >= queued[0]['rank']:
+            return
+        cls, job = queued
+        cls['queue'].remove(job)
+        self._enqueue(target, job)
+        self._queued[key] = (target, job)
+        target['promoted'] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.workers:
+            eligible = [
+                c for c in self._classes.values()
+                if c['queue'] and c['active'] < c['limit']
+            ]
+            if not eligible:
+                return
+            # Stride scheduling: lowest pass goes next, advancing by 1/weight
+            cls = min(eligible, key=lambda c: c['pass'])
+            job = cls['queue'].popleft()
+            factory, future, queued, key = job
+            if self._queued.get(key, (None, None))[1] is job:
+                del self._queued[key]
+            if future.cancelled():
+                continue
+            self._vtime = cls['pass']
+            cls['pass'] += 1 / cls['weight']
+            cls['wait_total'] += time.monotonic() - queued
+            cls['active'] += 1
+            self.active += 1
+            asyncio.create_task(self._run(cls, factory, future))
+
+    async def _run(self, cls, factory, future):
+        try:
+            result = await factory()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            cls['active'] -= 1
+            cls['completed'] += 1
+            self.active -= 1
+            self._dispatch()
+
+    def stats(self):
+        return {
+            name: {
+                'queued': len(c['queue']),
+                'active': c['active'],
+                'completed': c['completed'],
+                'shed': c['shed'],
+                'promoted': c['promoted'],
+                'wait_avg_ms': c['wait_total'] / c['completed'] * 1000 if c['completed'] else 0.0
+            }
+            for name, c in self._classes.items()
+        }
+
+expansion_scheduler = ExpansionScheduler()
+# =============================================================
+
+# ==================== SINGLE FLIGHT ====================
+class SingleFlight:
+    """Share one in-flight resolution between concurrent callers of the same key"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key, factory):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.leaders += 1
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure doesn't log a warning
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        return {
+            'inflight': len(self._inflight),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
+
+expansion_flight = SingleFlight()
+# =======================================================
+
+async def expand_short_url(short_url, priority='free'):
+    """Expand short URLs, serving repeat links from the expansion cache"""
+    # Embedded destinations such as ?url= are unwrapped in memory
+    short_url = tracking_rules.unwrap(short_url)
+    # Ordinary links only need parameter stripping, not a network call
+    if not needs_expansion(short_url):
+        return short_url
+    key = normalize_cache_key(short_url)
+    cached = await expansion_cache.get(key)
+    if cached is not None:
+        return cached
+    # Joining an in-flight expansion must not leave it waiting at the leader's lower priority
+    expansion_scheduler.promote(key, priority)
+    return await expansion_flight.run(key, lambda: _expand_and_cache(key, short_url, priority))
+
+async def _expand_and_cache(key, short_url, priority):
+    expanded, outcome = await expansion_scheduler.submit(
+        priority, lambda: _resolve_short_url(short_url, priority), key=key
+    )
+    if outcome == 'host_busy':
+        # Our own congestion says nothing about the link, so the next caller should retry it
+        return expanded
+    # A chain that broke part way stopped at an intermediate URL, not the destination
+    negative = (outcome in ('failed', 'partial', 'circuit_open')
+                or expanded == short_url or expanded.endswith("(Shortened - could not expand)"))
+    await expansion_cache.set(key, expanded, negative=negative)
+    return expanded
+
+# ==================== HOST GUARDS ====================
+# Position in EXPANSION_CLASSES; lower ranks get host slots first
+HOST_CLASS_RANKS = {name: rank for rank, name in enumerate(EXPANSION_CLASSES)}
+
+class HostSlots:
+    """Per-host concurrency slots handed out by class rank, keeping a few back for premium and admin"""
+
+    def __init__(self, slots, reserved=HOST_RESERVED_SLOTS):
+        self.available = slots
+        self.reserved = max(0, min(reserved, slots - 1))
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _can_take(self, rank):
+        # Free and bulk traffic must leave the reserved slots untouched
+        return self.available > (self.reserved if rank >= HOST_CLASS_RANKS['free'] else 0)
+
+    async def acquire(self, rank):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (rank, next(self._seq), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled: pass the slot on
+                self.release()
+            raise
+
+    def release(self):
+        self.available += 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            rank, _, future = self._waiters[0]
+            if future.done():
+                # Abandoned by a timed-out waiter
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_take(rank):
+                return
+            heapq.heappop(self._waiters)
+            self.available -= 1
+            future.set_result(None)
+
+class HostGuard:
+    """Concurrency cap, latency-based timeout and circuit breaker for one outbound host"""
+
+    def __init__(self, host, concurrency=HOST_CONCURRENCY):
+        self.host = host
+        self.slots = HostSlots(concurrency)
+        self.latency = None
+        self.deviation = 0.0
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.requests = 0
+        self.rejected = 0
+
+    def timeout(self):
+        """Expected latency plus four deviations, within [HOST_TIMEOUT_MIN, EXPAND_TIMEOUT]"""
+        if self.latency is None:
+            return EXPAND_TIMEOUT
+        return min(EXPAND_TIMEOUT, max(HOST_TIMEOUT_MIN, self.latency + 4 * self.deviation))
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Whether a request may go out now; half-open lets a single probe through"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def release_probe(self):
+        """Hand the half-open probe back when it ended without a result"""
+        self.probing = False
+
+    def record(self, ok, elapsed):
+        self.requests += 1
+        self.probing = False
+        if ok:
+            # Same smoothing as TCP's RTT estimator
+            if self.latency is None:
+                self.latency, self.deviation = elapsed, elapsed / 2
+            else:
+                self.deviation = 0.75 * self.deviation + 0.25 * abs(elapsed - self.latency)
+                self.latency = 0.875 * self.latency + 0.125 * elapsed
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+            logger.info(f"Circuit opened for {self.host} after {self.failures} failures")
+
+class HostGuards:
+    """Bounded registry of HostGuard objects keyed by hostname"""
+
+    def __init__(self, max_hosts=10000):
+        self.max_hosts = max_hosts
+        self._guards = OrderedDict()
+
+    def get(self, host):
+        guard = self._guards.get(host)
+        if guard is None:
+            guard = self._guards[host] = HostGuard(host)
+            while len(self._guards) > self.max_hosts:
+                self._guards.popitem(last=False)
+        else:
+            self._guards.move_to_end(host)
+        return guard
+
+    def open_circuits(self):
+        return [g.host for g in self._guards.values() if g.state != 'closed']
+
+    def slowest(self, n=5):
+        measured = [g for g in self._guards.values() if g.latency is not None]
+        return sorted(measured, key=lambda g: g.latency, reverse=True)[:n]
+
+host_guards = HostGuards()
+# =====================================================
+
+# ==================== REDIRECT RESOLVER ====================
+META_REFRESH_RE = re.compile(
+    r'<meta[^>]+http-equiv\s*=\s*["\']?refresh[^>]*>', re.IGNORECASE)
+META_REFRESH_URL_RE = re.compile(
+    r'content\s*=\s*["\']?\s*\d*\s*;?\s*url\s*=\s*["\']?([^"\'>\s]+)', re.IGNORECASE)
+JS_LOCATION_RE = re.compile(
+    r'(?:window\.|document\.|top\.|self\.)?location(?:\.href)?\s*=\s*["\']([^"\']+)["\']'
+    r'|location\.(?:replace|assign)\(\s*["\']([^"\']+)["\']\s*\)',
+    re.IGNORECASE)
+
+def sniff_html_redirect(body):
+    """Find a meta-refresh or JavaScript location redirect in an HTML prefix"""
+    meta = META_REFRESH_RE.search(body)
+    if meta:
+        target = META_REFRESH_URL_RE.search(meta.group(0))
+        if target:
+            return html.unescape(target.group(1)), 'meta-refresh'
+    script = JS_LOCATION_RE.search(body)
+    if script:
+        return html.unescape(script.group(1) or script.group(2)), 'javascript'
+    return None, None
+
+async def _read_prefix(response, limit):
+    """Read at most limit bytes, then release or abort the connection"""
+    # read(n) returns whatever chunk has arrived, so keep reading until limit or EOF
+    body = b''
+    while len(body) < limit:
+        chunk = await response.content.read(limit - len(body))
+        if not chunk:
+            break
+        body += chunk
+    if response.content.at_eof():
+        response.release()
+    else:
+        # Drop the rest of the transfer instead of downloading it
+        response.close()
+    return body
+
+async def resolve_redirect_chain(url, priority='free'):
+    """Follow redirects one hop at a time and return every hop with timings"""
+    rank = HOST_CLASS_RANKS.get(priority, HOST_CLASS_RANKS['free'])
+    session = await get_http_session()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + EXPAND_TIMEOUT
+    chain = []
+    seen = set()
+    current, via = url, 'start'
+
+    while len(chain) <= MAX_REDIRECT_HOPS:
+        if current in seen:
+            chain.append({'url': current, 'status': None, 'elapsed_ms': 0.0, 'via': 'loop'})
+            break
+        seen.add(current)
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        hop = {'url': current, 'status': None, 'elapsed_ms': 0.0, 'via': via}
+        chain.append(hop)
+        next_url = None
+        guard = host_guards.get((urlsplit(current).hostname or '').lower())
+        # Checked together with allow(), so this request is the half-open probe if True
+        probe = guard.state == 'half-open'
+        if not guard.allow():
+            # Known-bad host: give up now instead of burning the whole timeout
+            hop['error'] = 'circuit open'
+            break
+        recorded = False
+        try:
+            try:
+                await asyncio.wait_for(guard.slots.acquire(rank), remaining)
+            except asyncio.TimeoutError:
+                hop['error'] = 'host busy'
+                break
+            started = loop.time()
+            ok = False
+            try:
+                timeout = min(deadline - loop.time(), guard.timeout())
+                async with session.get(current, allow_redirects=False,
+                                       timeout=aiohttp.ClientTimeout(total=max(timeout, 0.1))) as response:
+                    hop['status'] = response.status
+                    ok = response.status < 500 and response.status not in (403, 429)
+                    location = response.headers.get('Location')
+                    if 300 <= response.status < 400 and location:
+                        next_url, via = location, 'location'
+                        await _read_prefix(response, SNIFF_BYTES)
+                    elif (response.status < 300 and 'html' in response.headers.get('Content-Type', '')
+                          and needs_expansion(current)):
+                        # Only shortener pages; ordinary pages have location code in onclick handlers
+                        body = await _read_prefix(response, SNIFF_BYTES)
+                        next_url, via = sniff_html_redirect(body.decode('utf-8', errors='ignore'))
+                    else:
+                        response.close()
+            except Exception as e:
+                hop['error'] = str(e) or type(e).__name__
+            finally:
+                guard.slots.release()
+            hop['elapsed_ms'] = (loop.time() - started) * 1000
+            guard.record(ok, hop['elapsed_ms'] / 1000)
+            recorded = True
+        finally:
+            if probe and not recorded:
+                # Busy or cancelled before a result: let the next request probe instead
+                guard.release_probe()
+
+        if not next_url:
+            break
+        current = urljoin(current, next_url.strip())
+
+    return chain
+
+def expansion_outcome(chain):
+    """Label a finished redirect chain for the expansion metrics"""
+    if not chain:
+        return 'unexpandable'
+    last = chain[-1]
+    if last['via'] == 'loop':
+        return 'loop'
+    if last.get('error') in ('circuit open', 'host busy'):
+        return last['error'].replace(' ', '_')
+    if 'error' in last:
+        # Failed on the first hop, or part way down the chain
+        return 'failed' if len(chain) == 1 else 'partial'
+    if len(chain) == 1:
+        return 'not_redirected'
+    if any(hop['via'] in ('meta-refresh', 'javascript') for hop in chain):
+        return 'html_redirect'
+    return 'location_redirect'
+
+async def _resolve_short_url(short_url, priority='free'):
+    """(expanded_url, outcome) for a short URL, walking its redirect chain"""
+    started = time.perf_counter()
+    # Label by the matched shortener domain so the host label stays low-cardinality
+    host = shortener_domain(urlsplit(short_url).netloc) or 'other'
+    outcome = 'error'
+    try:
+        chain = await resolve_redirect_chain(short_url, priority)
+        outcome = expansion_outcome(chain)
+        # A redirect loop never reaches a destination, so treat it as unexpandable
+        if chain and chain[-1]['via'] != 'loop' and chain[-1]['url'] != short_url:
+            return chain[-1]['url'], outcome
         
-        # Method 3: Check if it's a known shortener
+        # Check if it's a known shortener
         parsed = urlparse(short_url)
-        if parsed.netloc in SHORTENER_HOSTS:
-            return f"{short_url} (Shortened - could not expand)"
+        if is_shortener_host(parsed.netloc):
+            return f"{short_url} (Shortened - could not expand)", outcome
         
-        return short_url
+        return short_url, outcome
         
     except Exception as e:
         logger.error(f"Error expanding URL: {e}")
-        return short_url
+        return short_url, outcome
+    finally:
+        EXPANSION_SECONDS.observe(time.perf_counter() - started, host, outcome)
+# ===========================================================
+
+async def clean_ad_url(url, priority='free'):
+    """Expand a URL and remove its tracking parameters"""
+    # First expand short URLs
+    expanded_url = await expand_short_url(url, priority)
+    return strip_tracking_params(expanded_url)
+
+def strip_tracking_params(url):
+    """Remove tracking parameters from an already expanded URL"""
+    tracking_rules.maybe_reload()
+    return _strip_tracking_params(url)
+
+def clean_urls(urls):
+    """Strip tracking parameters from many URLs, yielding results in order"""
+    tracking_rules.maybe_reload()
+    for url in urls:
+        yield _strip_tracking_params(url)
 
-def clean_ad_url(url):
-    """Remove tracking parameters from URLs"""
+def _strip_tracking_params(url):
     try:
-        # First expand short URLs
-        expanded_url = expand_short_url(url)
-        
-        parsed = urlparse(expanded_url)
-        
-        # Keep only non-tracking query parameters
-        query_params = parse_qs(parsed.query)
-        clean_params = {}
-        
-        for key, values in query_params.items():
-            key_lower = key.lower()
-            # USE YOUR TRACKING_PARAMS SET HERE
-            is_tracking = key_lower in TRACKING_PARAMS
-            
-            if not is_tracking:
-                clean_params[key] = values[0] if len(values) == 1 else values
-        
-        # Rebuild clean URL
-        clean_query = '&'.join([f"{k}={v}" for k, v in clean_params.items()])
-        clean_url = urlunparse((
-            parsed.scheme,
-            parsed.netloc,
-            parsed.path,
-            parsed.params,
-            clean_query,
-            parsed.fragment
-        ))
-        
-        return clean_url
+        parts = urlsplit(url)
+        providers = tracking_rules.providers_for(url, parts.netloc)
+        if any(p.complete for p in providers):
+            # ClearURLs marks whole tracking domains this way; the link has nothing worth keeping
+            return BLOCKED_URL_TEXT
+
+        # Path-embedded trackers such as Amazon's /ref=...
+        path = parts.path
+        for provider in providers:
+            for raw_rule in provider.raw_rules:
+                path = raw_rule.sub('', path)
+
+        query = parts.query
+        if query:
+            # Scan the raw query so kept parameters are copied byte for byte
+            kept = []
+            for segment in query.split('&'):
+                if not segment:
+                    continue
+                key = segment.partition('=')[0]
+                if '%' in key or '+' in key:
+                    key = unquote_plus(key)
+                if not any(p.is_tracking(key) for p in providers):
+                    kept.append(segment)
+            query = '&'.join(kept)
+        elif path == parts.path:
+            return url
+
+        return urlunsplit((parts.scheme, parts.netloc, path, query, parts.fragment))
         
     except Exception as e:
         logger.error(f"Error cleaning URL: {e}")
         return url
 
+# ==================== USER REPOSITORY ====================
+def new_user_doc(user_id, referral_id=None):
+    """Default document for a user seen for the first time"""
+    return {
+        'user_id': user_id,
+        'is_premium': True,
+        'premium_until': datetime.now() + timedelta(hours=24),
+        'total_cleaned': 0,
+        'referral_id': referral_id,
+        'referral_count': 0,
+        'last_used': None,
+        'join_date': datetime.now(),
+        'free_trial_used': True
+    }
+
+class UserProfile:
+    """Compact projection of the user fields handlers actually read"""
+    __slots__ = ('user_id', 'is_premium', 'premium_until', 'total_cleaned',
+                 'referral_count', 'join_date', 'last_used')
+
+    def __init__(self, doc):
+        self.user_id = doc.get('user_id')
+        self.is_premium = doc.get('is_premium', False)
+        self.premium_until = doc.get('premium_until')
+        self.total_cleaned = doc.get('total_cleaned', 0)
+        self.referral_count = doc.get('referral_count', 0)
+        self.join_date = doc.get('join_date')
+        self.last_used = doc.get('last_used')
+
+def is_premium_active(user):
+    """Premium flag, treating a passed premium_until as expired"""
+    premium_until = user.premium_until
+    if premium_until and isinstance(premium_until, datetime) and datetime.now() > premium_until:
+        return False
+    return user.is_premium
+
+class UserCache:
+    """Bounded LRU of UserProfile records with a TTL"""
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, user_id):
+        """Cached profile without touching the stats or LRU order"""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def setdefault(self, profile):
+        """Cache profile unless a live record for the user is already there"""
+        entry = self._entries.get(profile.user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        self.put(profile)
+        return profile
+
+    def put(self, profile):
+        self._entries[profile.user_id] = (profile, time.monotonic() + self.ttl)
+        self._entries.move_to_end(profile.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def memory_bytes(self):
+        """Approximate footprint of the cache and its records"""
+        total = sys.getsizeof(self._entries)
+        for profile, _ in self._entries.values():
+            total += sys.getsizeof(profile) + 64
+        return total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'memory_bytes': self.memory_bytes()
+        }
+
+class CounterBuffer:
+    """Write-behind buffer merging per-key counter deltas into periodic bulk writes"""
+
+    def __init__(self, collection, key_field='user_id', upsert=False,
+                 interval=COUNTER_FLUSH_INTERVAL, max_ops=COUNTER_FLUSH_OPS):
+        self.collection = collection
+        self.key_field = key_field
+        self.upsert = upsert
+        self.interval = interval
+        self.max_ops = max_ops
+        self._pending = {}
+        self._ops = 0
+        self._wake = None
+        self._task = None
+        self.flushes = 0
+        self.flushed_ops = 0
+
+    def add(self, key, set_fields=None, on_insert=None, **deltas):
+        entry = self._pending.setdefault(key, {'$inc': {}, '$set': {}, '$setOnInsert': {}})
+        for field, delta in deltas.items():
+            entry['$inc'][field] = entry['$inc'].get(field, 0) + delta
+        if set_fields:
+            entry['$set'].update(set_fields)
+        if on_insert:
+            entry['$setOnInsert'].update(on_insert)
+        self._ops += 1
+        if self._ops >= self.max_ops and self._wake is not None:
+            self._wake.set()
+
+    def pending(self, key, field):
+        """Delta for field that has not reached Mongo yet"""
+        entry = self._pending.get(key)
+        return entry['$inc'].get(field, 0) if entry else 0
+
+    def pending_users(self):
+        return len(self._pending)
+
+    def apply_pending(self, profile):
+        """Overlay buffered deltas on a profile read from Mongo"""
+        entry = self._pending.get(profile.user_id)
+        if entry:
+            for field, delta in entry['$inc'].items():
+                setattr(profile, field, getattr(profile, field) + delta)
+            for field, value in entry['$set'].items():
+                setattr(profile, field, value)
+        return profile
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending, self._ops = self._pending, {}, 0
+        requests = [
+            UpdateOne(
+                {self.key_field: key},
+                {op: fields for op, fields in update.items() if fields},
+                upsert=self.upsert
+            )
+            for key, update in pending.items()
+        ]
+        try:
+            await asyncio.to_thread(self.collection.bulk_write, requests, ordered=False)
+            self.flushes += 1
+            self.flushed_ops += len(requests)
+        except BulkWriteError as e:
+            logger.error(f"Error flushing counters: {len(e.details['writeErrors'])} of {len(requests)} writes failed")
+            # Unordered writes still applied the others; retrying them would double count
+            keys = list(pending)
+            for error in e.details['writeErrors']:
+                self._requeue(keys[error['index']], pending[keys[error['index']]])
+        except Exception as e:
+            logger.error(f"Error flushing counters: {e}")
+            # Put the deltas back so the next flush retries them
+            for key, update in pending.items():
+                self._requeue(key, update)
+
+    def _requeue(self, key, update):
+        entry = self._pending.setdefault(key, {'$inc': {}, '$set': {}, '$setOnInsert': {}})
+        for field, delta in update['$inc'].items():
+            entry['$inc'][field] = entry['$inc'].get(field, 0) + delta
+        # Values set since the failed flush are newer and win
+        for op in ('$set', '$setOnInsert'):
+            entry[op] = {**update[op], **entry[op]}
+        self._ops += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the flush loop and drain whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+class UserRepository:
+    """Async access to the users collection; pymongo calls run in worker threads"""
+
+    # Referral ids live in their own collection; never load legacy arrays
+    PROJECTION = {'referrals': 0}
+
+    def __init__(self, collection, referrals, state):
+        self.collection = collection
+        self.referrals = referrals
+        # One-off flags such as finished migrations
+        self.state = state
+        self.counters = CounterBuffer(collection)
+        self.cache = UserCache()
+
+    def ensure_indexes(self):
+        try:
+            self._ensure_unique_user_id()
+        except Exception as e:
+            logger.error(f"Error creating user index: {e}. Remove duplicate user_id documents and restart.")
+        try:
+            self.referrals.create_index([('referrer_id', 1), ('referee_id', 1)], unique=True)
+        except Exception as e:
+            logger.error(f"Error creating referrals index: {e}")
+
+    def _ensure_unique_user_id(self):
+        index = self.collection.index_information().get('user_id_1')
+        if index and index.get('unique'):
+            return
+        try:
+            self.collection.create_index('user_id', unique=True)
+        except DuplicateKeyError:
+            # Only a build that hits duplicates pays for the full-collection scan
+            self._dedupe_users()
+            self.collection.create_index('user_id', unique=True)
+
+    def _dedupe_users(self):
+        """Drop duplicate user documents left by the old check-then-insert, keeping the oldest"""
+        duplicates = list(self.collection.aggregate([
+            {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ], allowDiskUse=True))
+        removed = 0
+        for group in duplicates:
+            # The oldest document is the one updates have been landing on
+            extra = sorted(group['ids'])[1:]
+            removed += self.collection.delete_many({'_id': {'$in': extra}}).deleted_count
+        if removed:
+            logger.warning(f"Removed {removed} duplicate documents for {len(duplicates)} users")
+
+    async def _upsert(self, user_id, update):
+        """find_one_and_update with upsert, returning (before_doc, created)"""
+        for attempt in range(2):
+            try:
+                before = await asyncio.to_thread(
+                    self.collection.find_one_and_update,
+                    {'user_id': user_id},
+                    update,
+                    projection=self.PROJECTION,
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE
+                )
+                return before, before is None
+            except DuplicateKeyError:
+                # Lost a first-contact race against a concurrent upsert; retry as an update
+                if attempt:
+                    raise
+
+    def _remember(self, doc):
+        # Concurrent misses must share one record so write-through updates aren't lost
+        return self.cache.setdefault(self.counters.apply_pending(UserProfile(doc)))
+
+    async def get(self, user_id):
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            return profile
+        doc = await asyncio.to_thread(self.collection.find_one, {'user_id': user_id}, self.PROJECTION)
+        return self._remember(doc) if doc else None
+
+    async def get_or_create(self, user_id, referral_id=None):
+        """Return (user, created), from cache or a single upsert round trip"""
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            return profile, False
+        defaults = new_user_doc(user_id, referral_id)
+        # Any contact means the user can be reached again, so clear a stale blocked flag
+        before, created = await self._upsert(user_id, {'$setOnInsert': defaults, '$unset': {'blocked': ''}})
+        return self._remember(defaults if created else before), created
+
+    def record_clean(self, user, count=1):
+        """Buffer usage counters for a clean and mirror them on the cached profile"""
+        now = datetime.now()
+        self.counters.add(user.user_id, {'last_used': now}, total_cleaned=count)
+        user.total_cleaned += count
+        user.last_used = now
+
+    async def expire_premium(self, user_id):
+        profile = self.cache.peek(user_id)
+        if profile is not None:
+            profile.is_premium = False
+        await asyncio.to_thread(
+            self.collection.update_one, {'user_id': user_id}, {'$set': {'is_premium': False}}
+        )
+
+    async def add_referral(self, referrer_id, user_id):
+        """Record a referral and credit a reward on every REFERRALS_PER_REWARD-th one.
+
+        Returns the new premium_until when a reward was granted, otherwise None.
+        """
+        try:
+            await asyncio.to_thread(self.referrals.insert_one, {
+                'referrer_id': referrer_id,
+                'referee_id': user_id,
+                'created_at': datetime.now()
+            })
+        except DuplicateKeyError:
+            return None
+        doc = await asyncio.to_thread(
+            self.collection.find_one_and_update,
+            {'user_id': referrer_id},
+            {'$inc': {'referral_count': 1}},
+            projection={'referral_count': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return None
+        profile = self.cache.peek(referrer_id)
+        if profile is not None:
+            profile.referral_count = doc['referral_count']
+        if doc['referral_count'] % REFERRALS_PER_REWARD:
+            return None
+        return await self.extend_premium(referrer_id, timedelta(days=PREMIUM_DAYS_PER_REWARD))
+
+    async def extend_premium(self, user_id, duration):
+        """Add duration to premium, starting now if it already lapsed"""
+        now = datetime.now()
+        doc = await asyncio.to_thread(
+            self.collection.find_one_and_update,
+            {'user_id': user_id},
+            [{'$set': {
+                'is_premium': True,
+                'premium_until': {'$add': [
+                    {'$max': [{'$ifNull': ['$premium_until', now]}, now]},
+                    int(duration.total_seconds() * 1000)
+                ]}
+            }}],
+            projection={'premium_until': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return None
+        profile = self.cache.peek(user_id)
+        if profile is not None:
+            profile.is_premium = True
+            profile.premium_until = doc['premium_until']
+        return doc['premium_until']
+
+    async def migrate_referrals(self):
+        """Move legacy referrals arrays into the referrals collection"""
+        def migrate():
+            # The unindexed scan only has to run until one pass finds nothing left
+            if self.state.find_one({'_id': 'migration:referrals'}):
+                return []
+            moved = []
+            for doc in self.collection.find({'referrals': {'$exists': True}}, {'user_id': 1, 'referrals': 1}):
+                referees = doc.get('referrals') or []
+                if referees:
+                    try:
+                        self.referrals.insert_many([
+                            {'referrer_id': doc['user_id'], 'referee_id': referee, 'created_at': datetime.now()}
+                            for referee in referees
+                        ], ordered=False)
+                    except Exception:
+                        # Duplicates from an interrupted earlier run are expected
+                        pass
+                count = self.referrals.count_documents({'referrer_id': doc['user_id']})
+                self.collection.update_one(
+                    {'_id': doc['_id']},
+                    {'$set': {'referral_count': count}, '$unset': {'referrals': ''}}
+                )
+                moved.append(doc['user_id'])
+            self.state.replace_one(
+                {'_id': 'migration:referrals'},
+                {'_id': 'migration:referrals', 'finished_at': datetime.now()},
+                upsert=True
+            )
+            return moved
+
+        try:
+            moved = await asyncio.to_thread(migrate)
+            # The cache is only touched from the event loop, never from the worker thread
+            for user_id in moved:
+                self.cache.invalidate(user_id)
+            if moved:
+                logger.info(f"Migrated referrals for {len(moved)} users")
+        except Exception as e:
+            logger.error(f"Error migrating referrals: {e}")
+
+    async def set_premium(self, user_id, premium_until):
+        result = await asyncio.to_thread(
+            self.collection.update_one,
+            {'user_id': user_id},
+            {'$set': {'is_premium': True, 'premium_until': premium_until}},
+            upsert=True
+        )
+        profile = self.cache.peek(user_id)
+        if profile is not None:
+            profile.is_premium = True
+            profile.premium_until = premium_until
+        return result
+
+    async def user_ids_after(self, last_user_id, limit):
+        """Next page of reachable user ids in user_id order, for streaming"""
+        query = {'blocked': {'$ne': True}}
+        if last_user_id is not None:
+            query['user_id'] = {'$gt': last_user_id}
+        return await asyncio.to_thread(
+            lambda: [u['user_id'] for u in self.collection.find(
+                query, {'user_id': 1, '_id': 0}, sort=[('user_id', 1)], limit=limit
+            )]
+        )
+
+    async def mark_blocked(self, user_ids):
+        """Flag users who blocked the bot so later broadcasts and pruning skip them"""
+        if user_ids:
+            await asyncio.to_thread(
+                self.collection.update_many,
+                {'user_id': {'$in': list(user_ids)}},
+                {'$set': {'blocked': True}}
+            )
+            # Evict so the next contact misses the cache and the upsert clears the flag
+            for user_id in user_ids:
+                self.cache.invalidate(user_id)
+
+user_repo = UserRepository(users_collection, referrals_collection, metrics_collection)
+# =========================================================
+
+# ==================== DAILY QUOTA ====================
+class DailyQuota:
+    """Per-user usage counts bucketed by day, checked in memory and persisted write-behind"""
+
+    def __init__(self, collection, retention_days=QUOTA_RETENTION_DAYS):
+        self.collection = collection
+        self.retention_days = retention_days
+        self.buckets = CounterBuffer(collection, key_field='_id', upsert=True)
+        self._day = None
+        self._counts = {}
+
+    @staticmethod
+    def _bucket_id(user_id, day):
+        return f"{user_id}:{day}"
+
+    def _today(self):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self._day:
+            # New day: yesterday's counts are no longer needed in memory
+            self._day = day
+            self._counts = {}
+        return day
+
+    def ensure_indexes(self):
+        """Old buckets expire on their own instead of a daily reset job"""
+        try:
+            self.collection.create_index('expires_at', expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Error creating quota index: {e}")
+
+    async def used_today(self, user_id):
+        day = self._today()
+        count = self._counts.get(user_id)
+        if count is None:
+            bucket_id = self._bucket_id(user_id, day)
+            try:
+                doc = await asyncio.to_thread(self.collection.find_one, {'_id': bucket_id})
+            except Exception as e:
+                logger.error(f"Error reading quota bucket: {e}")
+                doc = None
+            stored = (doc or {}).get('count', 0) + self.buckets.pending(bucket_id, 'count')
+            # A concurrent caller may have loaded and consumed in the meantime
+            if self._day == day:
+                count = self._counts.setdefault(user_id, stored)
+            else:
+                count = stored
+        return count
+
+    async def try_consume(self, user_id, limit=None):
+        """Atomically check and take one use; returns (allowed, used_today)"""
+        used = await self.used_today(user_id)
+        # No awaits from here on, so concurrent calls can't overshoot the limit
+        day = self._today()
+        used = self._counts.get(user_id, used)
+        if limit is not None and used >= limit:
+            return False, used
+        used += 1
+        self._counts[user_id] = used
+        self.buckets.add(
+            self._bucket_id(user_id, day),
+            on_insert={
+                'user_id': user_id,
+                'day': day,
+                'expires_at': datetime.strptime(day, '%Y-%m-%d') + timedelta(days=self.retention_days)
+            },
+            count=1
+        )
+        return True, used
+
+    def release(self, user_id):
+        """Give back a use that was taken for a failed clean"""
+        day = self._today()
+        if self._counts.get(user_id, 0) > 0:
+            self._counts[user_id] -= 1
+            self.buckets.add(self._bucket_id(user_id, day), count=-1)
+
+    def peek_used(self, user_id):
+        """Today's count if it is already in memory, else None; never touches Mongo"""
+        self._today()
+        return self._counts.get(user_id)
+
+daily_quota = DailyQuota(quota_collection)
+# =====================================================
+
+# ==================== ADMIN METRICS ====================
+class AdminMetrics:
+    """Incrementally maintained admin counters, periodically reconciled against Mongo"""
+
+    def __init__(self, collection, reconcile_interval=METRICS_RECONCILE_INTERVAL):
+        self.collection = collection
+        self.reconcile_interval = reconcile_interval
+        self.counters = CounterBuffer(collection, key_field='_id', upsert=True)
+        self.total_users = 0
+        self.active_today = 0
+        self.cleaned_today = 0
+        self._day = None
+        self._premium = {}
+        self._expiries = []
+        self._task = None
+
+    def _today(self):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self._day:
+            self._day = day
+            self.active_today = 0
+            self.cleaned_today = 0
+        return day
+
+    def user_created(self, user):
+        self.total_users += 1
+        self.counters.add('totals', total_users=1)
+        if user.is_premium:
+            self.premium_set(user.user_id, user.premium_until)
+
+    def premium_set(self, user_id, premium_until):
+        premium_until = premium_until or datetime.max
+        self._premium[user_id] = premium_until
+        heapq.heappush(self._expiries, (premium_until, user_id))
+
+    def user_active(self):
+        day = self._today()
+        self.active_today += 1
+        self.counters.add(f'day:{day}', active_users=1)
+
+    def cleaned(self, count=1):
+        day = self._today()
+        self.cleaned_today += count
+        self.counters.add(f'day:{day}', cleaned=count)
+
+    def premium_users(self):
+        """Premium users whose premium_until is still in the future"""
+        now = datetime.now()
+        while self._expiries and self._expiries[0][0] <= now:
+            until, user_id = heapq.heappop(self._expiries)
+            if self._premium.get(user_id) == until:
+                del self._premium[user_id]
+        return len(self._premium)
+
+    def snapshot(self):
+        self._today()
+        return {
+            'total_users': self.total_users,
+            'premium_users': self.premium_users(),
+            'active_today': self.active_today,
+            'cleaned_today': self.cleaned_today
+        }
+
+    async def reconcile(self):
+        """Recount from source collections to correct any drift"""
+        # Counts must include everything still sitting in write-behind buffers
+        await user_repo.counters.flush()
+        await daily_quota.buckets.flush()
+        await self.counters.flush()
+        day = self._today()
+        now = datetime.now()
+
+        def premium_expiries():
+            # Streamed with a projection; one aggregate result document would hit the 16 MB limit
+            premium = {}
+            cursor = user_repo.collection.find(
+                {'is_premium': True, '$or': [{'premium_until': None}, {'premium_until': {'$gt': now}}]},
+                {'_id': 0, 'user_id': 1, 'premium_until': 1}
+            )
+            for doc in cursor:
+                premium[doc['user_id']] = doc.get('premium_until') or datetime.max
+            expiries = [(until, user_id) for user_id, until in premium.items()]
+            heapq.heapify(expiries)
+            return premium, expiries
+
+        def usage():
+            return list(daily_quota.collection.aggregate([
+                {'$match': {'day': day}},
+                {'$group': {'_id': None, 'active': {'$sum': 1}, 'cleaned': {'$sum': '$count'}}}
+            ]))
+
+        # Recounted one by one so a failure in one keeps the others correct
+        requests = []
+        try:
+            self.total_users = await asyncio.to_thread(user_repo.collection.count_documents, {})
+            requests.append(UpdateOne({'_id': 'totals'}, {'$set': {'total_users': self.total_users}}, upsert=True))
+        except Exception as e:
+            logger.error(f"Error counting users: {e}")
+        try:
+            self._premium, self._expiries = await asyncio.to_thread(premium_expiries)
+        except Exception as e:
+            logger.error(f"Error loading premium users: {e}")
+        try:
+            today = await asyncio.to_thread(usage)
+            self.active_today = today[0]['active'] if today else 0
+            self.cleaned_today = today[0]['cleaned'] if today else 0
+            requests.append(UpdateOne({'_id': f'day:{day}'}, {'$set': {
+                'active_users': self.active_today,
+                'cleaned': self.cleaned_today
+            }}, upsert=True))
+        except Exception as e:
+            logger.error(f"Error counting today's usage: {e}")
+        if not requests:
+            return
+        try:
+            await asyncio.to_thread(self.collection.bulk_write, requests, ordered=False)
+        except Exception as e:
+            logger.error(f"Error saving admin metrics: {e}")
+
+    async def _run(self):
+        while True:
+            await self.reconcile()
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self):
+        self.counters.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.counters.stop()
+
+admin_metrics = AdminMetrics(metrics_collection)
+# =======================================================
+
+# ==================== BROADCAST ====================
+class TokenBucket:
+    """Async token bucket limiting how often acquire() returns"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds):
+        """Stop handing out tokens, e.g. after a RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class BroadcastManager:
+    """Background broadcast jobs with checkpoints so they resume after a restart"""
+
+    def __init__(self, collection, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 batch_size=BROADCAST_BATCH_SIZE):
+        self.collection = collection
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._tasks = {}
+
+    async def start_job(self, bot, message, admin_chat_id):
+        progress = await bot.send_message(chat_id=admin_chat_id, text="📢 Starting broadcast...")
+        job = {
+            '_id': ObjectId(),
+            'message': message,
+            'status': 'running',
+            'admin_chat_id': admin_chat_id,
+            'progress_message_id': progress.message_id,
+            'last_user_id': None,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'started_at': datetime.now()
+        }
+        await asyncio.to_thread(self.collection.insert_one, job)
+        self._spawn(bot, job)
+        return job['_id']
+
+    async def resume_all(self, bot):
+        """Pick up jobs that were still running when the process stopped"""
+        try:
+            jobs = await asyncio.to_thread(lambda: list(self.collection.find({'status': 'running'})))
+        except Exception as e:
+            logger.error(f"Error loading broadcast jobs: {e}")
+            return
+        for job in jobs:
+            logger.info(f"Resuming broadcast {job['_id']} after user {job.get('last_user_id')}")
+            self._spawn(bot, job)
+
+    def _spawn(self, bot, job):
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job['_id']] = (task, job)
+        task.add_done_callback(lambda _: self._tasks.pop(job['_id'], None))
+
+    def running(self):
+        return [job for _, job in self._tasks.values()]
+
+    async def stop(self):
+        """Cancel running jobs; their checkpoints let them resume on next start"""
+        for task, _ in list(self._tasks.values()):
+            task.cancel()
+        for task, _ in list(self._tasks.values()):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _send(self, bot, user_id, text, job, blocked):
+        for _ in range(3):
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+                job['sent'] += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.limiter.pause(retry_after)
+            except Forbidden:
+                blocked.append(user_id)
+                job['blocked'] += 1
+                return
+            except TelegramError:
+                break
+        job['failed'] += 1
+
+    async def _checkpoint(self, job, **fields):
+        await asyncio.to_thread(
+            self.collection.update_one,
+            {'_id': job['_id']},
+            {'$set': {
+                'last_user_id': job['last_user_id'],
+                'sent': job['sent'],
+                'failed': job['failed'],
+                'blocked': job['blocked'],
+                **fields
+            }}
+        )
+
+    async def _report(self, bot, job, text):
+        try:
+            await bot.edit_message_text(
+                chat_id=job['admin_chat_id'],
+                message_id=job['progress_message_id'],
+                text=text
+            )
+        except TelegramError as e:
+            logger.error(f"Error updating broadcast progress: {e}")
+
+    def progress_text(self, job):
+        return (
+            f"📢 Broadcast in progress...\n"
+            f"• Sent: {job['sent']}\n"
+            f"• Failed: {job['failed']}\n"
+            f"• Blocked: {job['blocked']}"
+        )
+
+    async def _run(self, bot, job):
+        text = f"📢 Admin Broadcast:\n\n{job['message']}"
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = 0.0
+
+        async def send(user_id, blocked):
+            async with semaphore:
+                await self._send(bot, user_id, text, job, blocked)
+
+        try:
+            while True:
+                batch = await user_repo.user_ids_after(job['last_user_id'], self.batch_size)
+                if not batch:
+                    break
+                blocked = []
+                await asyncio.gather(*(send(user_id, blocked) for user_id in batch))
+                await user_repo.mark_blocked(blocked)
+                # Whole batch is done, so everything up to its last id can be skipped on resume
+                job['last_user_id'] = batch[-1]
+                await self._checkpoint(job)
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(bot, job, self.progress_text(job))
+
+            await self._checkpoint(job, status='done', finished_at=datetime.now())
+            await self._report(
+                bot, job,
+                f"✅ Broadcast completed!\n"
+                f"• Success: {job['sent']}\n"
+                f"• Failed: {job['failed']}\n"
+                f"• Blocked: {job['blocked']}"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in broadcast {job['_id']}: {e}")
+            await self._checkpoint(job, status='failed')
+            await self._report(bot, job, "❌ Error in broadcast.")
+
+broadcasts = BroadcastManager(broadcast_collection)
+# ===================================================
+
+# ==================== BULK FILE CLEANING ====================
+class BulkCleaner:
+    """Stream uploaded link lists through the cleaning pipeline into a CSV with an error column"""
+
+    URL_HEADERS = ('url', 'link', 'links', 'urls')
+
+    def __init__(self, concurrency=BULK_CONCURRENCY, max_lines=BULK_MAX_LINES,
+                 progress_interval=BULK_PROGRESS_INTERVAL):
+        self.concurrency = concurrency
+        self.max_lines = max_lines
+        self.progress_interval = progress_interval
+        self._tasks = {}
+
+    def running(self, user_id):
+        return user_id in self._tasks
+
+    def start_job(self, bot, user, document, chat_id, progress):
+        task = asyncio.create_task(self._run(bot, user, document, chat_id, progress))
+        self._tasks[user.user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user.user_id, None))
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        for task in list(self._tasks.values()):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def clean_line(self, url):
+        """(cleaned_url, error) for one input URL"""
+        if not url.lower().startswith(('http://', 'https://')):
+            return '', 'not a http(s) URL'
+        try:
+            expanded_url = await expand_short_url(url, 'bulk')
+        except Exception as e:
+            return '', f'error: {e}'
+        if expanded_url.endswith("(Shortened - could not expand)"):
+            return strip_tracking_params(url), 'could not expand'
+        return strip_tracking_params(expanded_url), ''
+
+    def read_rows(self, source, is_csv):
+        """Header for the output file plus a lazy iterator of (row, url) pairs"""
+        if not is_csv:
+            rows = ([line.strip()] for line in source if line.strip())
+            return ['url'], ((row, row[0]) for row in rows)
+        reader = csv.reader(source)
+        first = next(reader, None) or []
+        headers = [cell.strip().lower() for cell in first]
+        column = next((i for i, name in enumerate(headers) if name in self.URL_HEADERS), None)
+        if column is None:
+            # No header row we recognise: treat the first column as URLs and keep the row as data
+            column = 0
+            header = ['url'] + [f'column_{i + 1}' for i in range(1, len(first))]
+            reader = itertools.chain([first], reader)
+        else:
+            header = first
+        return header, ((row, row[column].strip() if column < len(row) else '') for row in reader if row)
+
+    async def clean_file(self, source_path, result_path, is_csv, on_progress=None):
+        """Clean source_path into result_path with bounded, order-preserving concurrency"""
+        totals = {'processed': 0, 'cleaned': 0, 'errors': 0, 'truncated': False}
+        last_report = time.monotonic()
+        window = deque()
+
+        def write(writer, row, result):
+            cleaned_url, error = result
+            writer.writerow(row + [cleaned_url, error])
+            totals['processed'] += 1
+            totals['errors' if error else 'cleaned'] += 1
+
+        with open(source_path, newline='', encoding='utf-8-sig', errors='replace') as source, \
+                open(result_path, 'w', newline='', encoding='utf-8') as result:
+            header, rows = self.read_rows(source, is_csv)
+            writer = csv.writer(result)
+            writer.writerow(header + ['cleaned_url', 'error'])
+            try:
+                for count, (row, url) in enumerate(rows):
+                    if count >= self.max_lines:
+                        totals['truncated'] = True
+                        break
+                    window.append((row, asyncio.create_task(self.clean_line(url))))
+                    # Only a window of lines is ever in flight, so memory stays flat for any file size
+                    if len(window) >= self.concurrency:
+                        row, task = window.popleft()
+                        write(writer, row, await task)
+                    if on_progress and time.monotonic() - last_report >= self.progress_interval:
+                        last_report = time.monotonic()
+                        await on_progress(totals)
+                while window:
+                    row, task = window.popleft()
+                    write(writer, row, await task)
+            finally:
+                for _, task in window:
+                    task.cancel()
+        return totals
+
+    def progress_text(self, totals, done=False):
+        text = (
+            f"{'✅ File cleaned!' if done else '⏳ Cleaning file...'}\n"
+            f"• Processed: {totals['processed']}\n"
+            f"• Cleaned: {totals['cleaned']}\n"
+            f"• Errors: {totals['errors']}"
+        )
+        if totals['truncated']:
+            text += f"\n⚠️ Stopped after {self.max_lines} lines - split larger files."
+        return text
+
+    async def _edit(self, bot, chat_id, message_id, text):
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        except TelegramError as e:
+            logger.error(f"Error updating bulk progress: {e}")
+
+    async def _run(self, bot, user, document, chat_id, progress):
+        async def report(totals):
+            await self._edit(bot, chat_id, progress.message_id, self.progress_text(totals))
+
+        name = document.file_name or 'links.txt'
+        stem, ext = os.path.splitext(name)
+        try:
+            with tempfile.TemporaryDirectory() as workdir:
+                source_path = os.path.join(workdir, 'source')
+                result_path = os.path.join(workdir, 'result.csv')
+                file = await bot.get_file(document.file_id)
+                await file.download_to_drive(source_path)
+                totals = await self.clean_file(source_path, result_path, ext.lower() == '.csv', report)
+                if totals['cleaned']:
+                    user_repo.record_clean(user, totals['cleaned'])
+                    admin_metrics.cleaned(totals['cleaned'])
+                await self._edit(bot, chat_id, progress.message_id, self.progress_text(totals, done=True))
+                with open(result_path, 'rb') as result:
+                    await bot.send_document(chat_id=chat_id, document=result, filename=f"{stem}_cleaned.csv")
+        except asyncio.CancelledError:
+            await self._edit(bot, chat_id, progress.message_id, "❌ File cleaning was interrupted. Please upload it again.")
+            raise
+        except Exception as e:
+            logger.error(f"Error cleaning file for {user.user_id}: {e}")
+            await self._edit(bot, chat_id, progress.message_id, "❌ Error cleaning file. Please check it's a UTF-8 .txt or .csv.")
+
+bulk_cleaner = BulkCleaner()
+# ============================================================
+
 async def start(update: Update, context: CallbackContext) -> None:
     try:
         user_id = update.effective_user.id
-        user = users_collection.find_one({'user_id': user_id})
+        # Check for referral
+        referral_id = context.args[0] if context.args else None
+        user, created = await user_repo.get_or_create(user_id, referral_id)
+        if created:
+            admin_metrics.user_created(user)
         
         # Add admin badge if user is admin
         admin_badge = " 👑" if is_admin(user_id) else ""
         
-        if not user:
-            # Check for referral
-            referral_id = context.args[0] if context.args else None
-            
-            new_user = {
-                'user_id': user_id,
-                'is_premium': True,
-                'premium_until': datetime.now() + timedelta(hours=24),
-                'usage_count': 0,
-                'total_cleaned': 0,
-                'referral_id': referral_id,
-                'referrals': [],
-                'last_used': None,
-                'join_date': datetime.now(),
-                'free_trial_used': True
-            }
-            
-            users_collection.insert_one(new_user)
-            
-            # Reward referrer
-            if referral_id and referral_id.isdigit():
-                users_collection.update_one(
-                    {'user_id': int(referral_id)},
-                    {'$push': {'referrals': user_id}}
-                )
+        # Reward referrer
+        if created and referral_id and referral_id.isdigit():
+            rewarded_until = await user_repo.add_referral(int(referral_id), user_id)
+            if rewarded_until:
+                admin_metrics.premium_set(int(referral_id), rewarded_until)
+                try:
+                    await context.bot.send_message(
+                        chat_id=int(referral_id),
+                        text=f"🎁 You earned {PREMIUM_DAYS_PER_REWARD} day premium for {REFERRALS_PER_REWARD} referrals!"
+                    )
+                except Exception as e:
+                    logger.error(f"Error notifying referrer: {e}")
         
+        # Underscores in the username would otherwise start Markdown italics
+        bot_username = context.bot.username.replace('_', '\\_')
         welcome_text = f"""
 🤖 Welcome to Ads Link Cleaner Bot!{admin_badge}
 
@@ -175,6 +2379,9 @@ I remove tracking parameters and clean ads from URLs!
 
 ✨ Features:
 • Clean ad tracking parameters
+• Send or forward a whole post - every link gets cleaned
+• Premium: upload a .txt/.csv list to clean it in bulk
+• Type @{bot_username} <link> in any chat to clean inline
 • {FREE_DAILY_LIMIT} free cleans daily
 • Premium for unlimited cleans
 • Referral rewards system
@@ -197,103 +2404,343 @@ Send me any URL with ads to get started! 🚀
         logger.error(f"Error in start: {e}")
         await update.message.reply_text("Welcome! Send me any URL to clean ads from it! 🚀")
 
+URL_ENTITY_TYPES = [MessageEntity.URL, MessageEntity.TEXT_LINK]
+
+def extract_urls(message):
+    """Every distinct URL in a message's text and caption entities, in order"""
+    found = []
+    for entities in (message.parse_entities(URL_ENTITY_TYPES), message.parse_caption_entities(URL_ENTITY_TYPES)):
+        for entity, text in entities.items():
+            url = entity.url if entity.type == MessageEntity.TEXT_LINK else text
+            if '://' not in url:
+                url = f"http://{url}"
+            found.append(url)
+    return list(dict.fromkeys(found))[:MAX_URLS_PER_MESSAGE]
+
+def expansion_display(url, expanded_url):
+    """What to show as the expanded URL, flagging shorteners we couldn't resolve"""
+    unresolved = expanded_url == url or expanded_url.endswith("(Shortened - could not expand)")
+    if unresolved and is_shortener_host(urlparse(url).netloc):
+        return "❌ Could not expand (link may be protected)"
+    return expanded_url
+
+def clip(text, limit=URL_DISPLAY_LIMIT):
+    """Shorten text that would not fit in one message on its own"""
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+def split_message(parts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Join parts with newlines into as few messages as fit the limit, never splitting a part"""
+    messages = []
+    current = None
+    for part in parts:
+        if current is not None and len(current) + 1 + len(part) > limit:
+            messages.append(current)
+            current = None
+        current = part if current is None else f"{current}\n{part}"
+    if current is not None:
+        messages.append(current)
+    return messages
+
 async def clean_url(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    urls = extract_urls(message)
+    if not urls and context.args:
+        urls = [' '.join(context.args)]
+    if not urls and message.reply_to_message:
+        # "/clean" sent as a reply cleans the links in the replied-to post
+        urls = extract_urls(message.reply_to_message)
+    
+    # Check if user provided URL
+    if not urls:
+        await message.reply_text("Please provide a URL to clean!\nExample: `/clean https://example.com?utm_source=facebook`", parse_mode='Markdown')
+        return
+    
+    await clean_and_reply(update, urls)
+
+async def clean_message(update: Update, context: CallbackContext) -> None:
+    """Clean every link in a plain or forwarded message"""
+    urls = extract_urls(update.effective_message)
+    if urls:
+        await clean_and_reply(update, urls)
+
+async def clean_and_reply(update: Update, urls) -> None:
+    message = update.effective_message
     try:
         user_id = update.effective_user.id
-        user = users_collection.find_one({'user_id': user_id})
-        
-        # If user doesn't exist, create them automatically
-        if not user:
-            new_user = {
-                'user_id': user_id,
-                'is_premium': True,
-                'premium_until': datetime.now() + timedelta(hours=24),
-                'usage_count': 0,
-                'total_cleaned': 0,
-                'referrals': [],
-                'last_used': None,
-                'join_date': datetime.now(),
-                'free_trial_used': True
-            }
-            users_collection.insert_one(new_user)
-            user = new_user
-        
-        # Check if user provided URL
-        if not context.args:
-            await update.message.reply_text("Please provide a URL to clean!\nExample: `/clean https://example.com?utm_source=facebook`", parse_mode='Markdown')
-            return
         
-        url = ' '.join(context.args)
+        user, created = await user_repo.get_or_create(user_id)
+        if created:
+            admin_metrics.user_created(user)
         
         # Check if premium expired
-        is_premium = user.get('is_premium', False)
-        premium_until = user.get('premium_until')
+        is_premium = is_premium_active(user)
+        if not is_premium and user.is_premium:
+            await user_repo.expire_premium(user_id)
         
-        if premium_until and isinstance(premium_until, datetime):
-            if datetime.now() > premium_until:
-                is_premium = False
-                users_collection.update_one(
-                    {'user_id': user_id},
-                    {'$set': {'is_premium': False}}
-                )
+        # Check daily limit for free users; each URL counts once
+        limit = None if is_premium else FREE_DAILY_LIMIT
+        used_before = await daily_quota.used_today(user_id)
+        allowed_urls = []
+        for url in urls:
+            allowed, used_today = await daily_quota.try_consume(user_id, limit)
+            if not allowed:
+                break
+            allowed_urls.append(url)
         
-        # Check daily limit for free users
-        if not is_premium and user.get('usage_count', 0) >= FREE_DAILY_LIMIT:
-            await update.message.reply_text(
+        if not allowed_urls:
+            await message.reply_text(
                 f"❌ Daily Limit Reached!\n\n"
-                f"You've used {user.get('usage_count', 0)}/{FREE_DAILY_LIMIT} free cleans today.\n"
+                f"You've used {used_today}/{FREE_DAILY_LIMIT} free cleans today.\n"
                 "Upgrade to premium for unlimited cleans!\n\n"
                 "Use /premium to learn more!",
                 parse_mode='Markdown'
             )
             return
         
-        # Clean the URL
-        cleaned_url = clean_ad_url(url)
-        expanded_url = expand_short_url(url)
+        priority = 'admin' if is_admin(user_id) else 'premium' if is_premium else 'free'
+        semaphore = asyncio.Semaphore(MESSAGE_URL_CONCURRENCY)
         
-        # Check if URL is a known shortener
-        parsed = urlparse(url)
-        is_shortened = parsed.netloc in SHORTENER_HOSTS
+        async def clean_one(url):
+            async with semaphore:
+                expanded_url = await expand_short_url(url, priority)
+                return expanded_url, strip_tracking_params(expanded_url)
+        
+        # Clean the URLs
+        results = await asyncio.gather(*(clean_one(url) for url in allowed_urls), return_exceptions=True)
+        cleaned = []
+        busy = 0
+        for url, result in zip(allowed_urls, results):
+            if isinstance(result, BaseException):
+                daily_quota.release(user_id)
+                if isinstance(result, ExpansionOverloaded):
+                    busy += 1
+                else:
+                    logger.error(f"Error cleaning URL {url}: {result}")
+                continue
+            cleaned.append((url, *result))
+        used_today = await daily_quota.used_today(user_id)
+        
+        if not cleaned:
+            if busy:
+                await message.reply_text(
+                    "⏳ We're very busy right now. Please try again in a minute!\n\n"
+                    "💎 Premium users get priority processing - see /premium"
+                )
+            else:
+                await message.reply_text("❌ Error cleaning URL. Please send a valid URL starting with http:// or https://")
+            return
         
-        if expanded_url == url and is_shortened:
-            expanded_display = "❌ Could not expand (link may be protected)"
+        footer = f"""
+📊 *Stats Today:* {used_today}/{FREE_DAILY_LIMIT}
+🎯 *Total Cleaned:* {user.total_cleaned + len(cleaned)}
+
+💎 *Status:* {'Premium (Free Trial)' if is_premium else 'Free'}
+"""
+        if len(urls) == 1 and len(cleaned) == 1:
+            url, expanded_url, cleaned_url = cleaned[0]
+            # Send cleaned URL with all steps shown
+            parts = [
+                "\nURL Cleaned Successfully! ✅\n",
+                f"*Shortened URL:* \n`{clip(url)}`\n",
+                f"*Expanded URL:* \n`{clip(expansion_display(url, expanded_url))}`\n",
+                f"*Final Cleaned URL:* \n`{clip(cleaned_url)}`",
+                footer
+            ]
         else:
-            expanded_display = expanded_url
+            lines = [f"{i}. `{clip(cleaned_url)}`" for i, (_, _, cleaned_url) in enumerate(cleaned, 1)]
+            skipped = len(urls) - len(allowed_urls)
+            notes = []
+            if skipped:
+                notes.append(f"⚠️ {skipped} link(s) skipped - daily limit reached. Use /premium for unlimited cleans!")
+            if busy:
+                notes.append(f"⏳ {busy} link(s) skipped - we're busy, please retry shortly.")
+            failed = len(allowed_urls) - len(cleaned) - busy
+            if failed:
+                notes.append(f"❌ {failed} link(s) could not be cleaned.")
+            parts = [f"\n{len(cleaned)} URLs Cleaned Successfully! ✅\n", *lines]
+            if notes:
+                parts.append('\n' + '\n'.join(notes))
+            parts.append(footer)
+        
+        try:
+            for text in split_message(parts):
+                await message.reply_text(text, parse_mode='Markdown')
+        except Exception:
+            # The user didn't get the result, so give the uses back
+            for _ in cleaned:
+                daily_quota.release(user_id)
+            raise
         
         # Update user stats
-        users_collection.update_one(
-            {'user_id': user_id},
-            {
-                '$inc': {'usage_count': 1, 'total_cleaned': 1},
-                '$set': {'last_used': datetime.now()}
-            }
-        )
+        user_repo.record_clean(user, len(cleaned))
+        admin_metrics.cleaned(len(cleaned))
+        if used_before == 0:
+            admin_metrics.user_active()
         
-        # Send cleaned URL with all steps shown
-        response_text = f"""
-URL Cleaned Successfully! ✅
+    except Exception as e:
+        logger.error(f"Error cleaning URL: {e}")
+        await message.reply_text("❌ Error cleaning URL. Please send a valid URL starting with http:// or https://")
 
-*Shortened URL:* 
-`{url}`
+INLINE_DOMAIN_RE = re.compile(r'^[\w-]+(?:\.[\w-]+)+(?::\d+)?(?:[/?#]\S*)?$')
 
-*Expanded URL:* 
-`{expanded_display}`
+def extract_inline_urls(query):
+    """URLs in an inline query's free text; bare domains get an http:// scheme"""
+    urls = []
+    for token in query.split():
+        if not token.lower().startswith(('http://', 'https://')):
+            if not INLINE_DOMAIN_RE.match(token):
+                continue
+            token = f"http://{token}"
+        urls.append(token)
+    return list(dict.fromkeys(urls))[:INLINE_MAX_URLS]
 
-*Final Cleaned URL:* 
-`{cleaned_url}`
+async def clean_inline(url, priority):
+    """(cleaned_url, final) from memory where possible, waiting only briefly on the network"""
+    unwrapped = tracking_rules.unwrap(url)
+    if not needs_expansion(unwrapped):
+        return strip_tracking_params(unwrapped), True
+    expanded = expansion_cache.get_local(normalize_cache_key(unwrapped))
+    if expanded is None:
+        # Keeps running after we answer, so a repeat of the query finds it in the cache
+        task = asyncio.ensure_future(expand_short_url(url, priority))
+        done, _ = await asyncio.wait({task}, timeout=INLINE_EXPAND_WAIT)
+        if task not in done or task.exception() is not None:
+            # Retrieve a late failure so it isn't logged as never retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return strip_tracking_params(unwrapped), False
+        expanded = task.result()
+    if expanded.endswith("(Shortened - could not expand)"):
+        return strip_tracking_params(unwrapped), True
+    return strip_tracking_params(expanded), True
 
-📊 *Stats Today:* {user.get('usage_count', 0) + 1}/{FREE_DAILY_LIMIT}
-🎯 *Total Cleaned:* {user.get('total_cleaned', 0) + 1}
+def _result_digest(text):
+    # Result ids are capped at 64 bytes
+    return hashlib.sha1(text.encode()).hexdigest()[:32]
 
-💎 *Status:* {'Premium (Free Trial)' if is_premium else 'Free'}
-"""
+def inline_article(result_id, title, text):
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=text[:200],
+        input_message_content=InputTextMessageContent(text)
+    )
+
+async def inline_clean(update: Update, context: CallbackContext) -> None:
+    """Answer '@bot <url>' from any chat with cleaned links, touching Mongo only afterwards"""
+    inline_query = update.inline_query
+    try:
+        user_id = inline_query.from_user.id
+        urls = extract_inline_urls(inline_query.query)
+        if not urls:
+            await inline_query.answer(
+                [], cache_time=INLINE_CACHE_TIME,
+                button=InlineQueryResultsButton(text="Paste a link to clean it", start_parameter="inline")
+            )
+            return
+        
+        # Only in-memory state is consulted here; unknown users are loaded in the background
+        user = user_repo.cache.peek(user_id)
+        is_premium = user is not None and is_premium_active(user)
+        used_today = daily_quota.peek_used(user_id)
+        if user is None or used_today is None:
+            context.application.create_task(_load_inline_user(user_id))
+        if not is_premium and used_today is not None and used_today >= FREE_DAILY_LIMIT:
+            await inline_query.answer(
+                [], cache_time=0, is_personal=True,
+                button=InlineQueryResultsButton(text="❌ Daily limit reached - get premium", start_parameter="premium")
+            )
+            return
+        
+        priority = 'admin' if is_admin(user_id) else 'premium' if is_premium else 'free'
+        cleaned = await asyncio.gather(*(clean_inline(url, priority) for url in urls))
+        results = []
+        if len(cleaned) > 1:
+            text = '\n'.join(cleaned_url for cleaned_url, _ in cleaned)
+            results.append(inline_article(f"{len(cleaned)}:all:{_result_digest(text)}", f"🧹 All {len(cleaned)} cleaned links", text))
+        for i, (cleaned_url, final) in enumerate(cleaned):
+            title = "🧹 Cleaned link" if final else "🧹 Cleaned link (still expanding - retype to refresh)"
+            results.append(inline_article(f"1:{i}:{_result_digest(cleaned_url)}", title, cleaned_url))
+        
+        # Unfinished expansions get a short cache so Telegram asks again once we have them
+        complete = all(final for _, final in cleaned)
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME if complete else INLINE_PENDING_CACHE_TIME)
+        
+    except Exception as e:
+        logger.error(f"Error answering inline query: {e}")
+
+async def _load_inline_user(user_id):
+    """Warm the profile and quota caches so the next inline query can check limits in memory"""
+    try:
+        user, created = await user_repo.get_or_create(user_id)
+        if created:
+            admin_metrics.user_created(user)
+        await daily_quota.used_today(user_id)
+    except Exception as e:
+        logger.error(f"Error loading inline user: {e}")
 
-        await update.message.reply_text(response_text, parse_mode='Markdown')
+async def inline_chosen(update: Update, context: CallbackContext) -> None:
+    """Deferred quota accounting for inline results the user actually sent"""
+    chosen = update.chosen_inline_result
+    try:
+        user_id = chosen.from_user.id
+        count = int(chosen.result_id.split(':', 1)[0])
+        user, created = await user_repo.get_or_create(user_id)
+        if created:
+            admin_metrics.user_created(user)
+        
+        limit = None if is_premium_active(user) else FREE_DAILY_LIMIT
+        used_before = await daily_quota.used_today(user_id)
+        consumed = 0
+        for _ in range(count):
+            allowed, _ = await daily_quota.try_consume(user_id, limit)
+            if not allowed:
+                break
+            consumed += 1
+        
+        if consumed:
+            user_repo.record_clean(user, consumed)
+            admin_metrics.cleaned(consumed)
+            if used_before == 0:
+                admin_metrics.user_active()
         
     except Exception as e:
-        logger.error(f"Error cleaning URL: {e}")
-        await update.message.reply_text("❌ Error cleaning URL. Please send a valid URL starting with http:// or https://")
+        logger.error(f"Error accounting inline result: {e}")
+
+async def clean_document(update: Update, context: CallbackContext) -> None:
+    """Bulk-clean an uploaded .txt or .csv link list for premium users"""
+    message = update.effective_message
+    document = message.document
+    try:
+        user_id = update.effective_user.id
+        user, created = await user_repo.get_or_create(user_id)
+        if created:
+            admin_metrics.user_created(user)
+        
+        if not (is_premium_active(user) or is_admin(user_id)):
+            await message.reply_text(
+                "💎 Bulk file cleaning is a premium feature.\n\n"
+                "Use /premium to upgrade, or send links one at a time with /clean."
+            )
+            return
+        
+        if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+            await message.reply_text(
+                f"❌ File too large. The limit is {BULK_MAX_FILE_SIZE // (1024 * 1024)} MB "
+                f"and {BULK_MAX_LINES} links per file."
+            )
+            return
+        
+        if bulk_cleaner.running(user_id):
+            await message.reply_text("⏳ Your previous file is still being cleaned. Please wait for it to finish.")
+            return
+        
+        # Run in the background so the user's other messages aren't held behind the file
+        progress = await message.reply_text("⏳ Cleaning file...")
+        bulk_cleaner.start_job(context.bot, user, document, message.chat_id, progress)
+        
+    except Exception as e:
+        logger.error(f"Error starting bulk clean: {e}")
+        await message.reply_text("❌ Error cleaning file. Please try again later.")
 
 async def premium_info(update: Update, context: CallbackContext) -> None:
     keyboard = [
@@ -309,6 +2756,7 @@ async def premium_info(update: Update, context: CallbackContext) -> None:
 • ✅ Unlimited URL cleaning
 • ✅ No daily limits
 • ✅ Priority processing
+• ✅ Bulk cleaning of .txt/.csv link lists
 • ✅ Exclusive features
 
 *Pricing:*
@@ -328,36 +2776,37 @@ Click below to get premium! 🚀
 async def stats(update: Update, context: CallbackContext) -> None:
     try:
         user_id = update.effective_user.id
-        user = users_collection.find_one({'user_id': user_id})
+        user = await user_repo.get(user_id)
         
         if not user:
             await update.message.reply_text("Please use /start first!")
             return
         
         # Check premium status
-        is_premium = user.get('is_premium', False)
-        premium_until = user.get('premium_until')
-        
-        if premium_until and isinstance(premium_until, datetime):
-            if datetime.now() > premium_until:
-                is_premium = False
+        is_premium = is_premium_active(user)
+        used_today = await daily_quota.used_today(user_id)
         
         status = "Premium 🎯" if is_premium else "Free ⭐"
-        referrals = len(user.get('referrals', []))
+        referrals = user.referral_count
         
         # Add admin info if user is admin
         admin_info = ""
         if is_admin(user_id):
-            total_users = users_collection.count_documents({})
-            premium_users = users_collection.count_documents({'is_premium': True})
-            admin_info = f"\n👑 Admin Stats:\n• Total Users: {total_users}\n• Premium Users: {premium_users}"
+            snapshot = admin_metrics.snapshot()
+            admin_info = (
+                f"\n👑 Admin Stats:\n"
+                f"• Total Users: {snapshot['total_users']}\n"
+                f"• Premium Users: {snapshot['premium_users']}\n"
+                f"• Active Today: {snapshot['active_today']}\n"
+                f"• Cleaned Today: {snapshot['cleaned_today']}"
+            )
         
         text = f"""
 📊 Your Statistics 📊
 
 *Status:* {status}
-*Today's Usage:* {user.get('usage_count', 0)}/{FREE_DAILY_LIMIT}
-*Total Cleaned:* {user.get('total_cleaned', 0)}
+*Today's Usage:* {used_today}/{FREE_DAILY_LIMIT}
+*Total Cleaned:* {user.total_cleaned}
 *Referrals:* {referrals}/{REFERRALS_PER_REWARD}
 {admin_info}
 
@@ -377,8 +2826,8 @@ async def referral_info(update: Update, context: CallbackContext) -> None:
         bot_username = (await context.bot.get_me()).username
         referral_link = f"https://t.me/{bot_username}?start={user_id}"
         
-        user = users_collection.find_one({'user_id': user_id})
-        referrals = len(user.get('referrals', [])) if user else 0
+        user = await user_repo.get(user_id)
+        referrals = user.referral_count if user else 0
         
         text = f"""
 📨 Referral Program 📨
@@ -458,16 +2907,8 @@ async def make_premium(update: Update, context: CallbackContext) -> None:
         
         premium_until = datetime.now() + timedelta(days=days)
         
-        users_collection.update_one(
-            {'user_id': target_id},
-            {
-                '$set': {
-                    'is_premium': True,
-                    'premium_until': premium_until
-                }
-            },
-            upsert=True
-        )
+        await user_repo.set_premium(target_id, premium_until)
+        admin_metrics.premium_set(target_id, premium_until)
         
         await update.message.reply_text(f"✅ User {target_id} is now premium for {days} days!")
         
@@ -487,15 +2928,15 @@ async def user_info(update: Update, context: CallbackContext) -> None:
     
     try:
         target_id = int(context.args[0])
-        user = users_collection.find_one({'user_id': target_id})
+        user = await user_repo.get(target_id)
         
         if not user:
             await update.message.reply_text("❌ User not found!")
             return
         
-        is_premium = user.get('is_premium', False)
-        premium_until = user.get('premium_until')
-        referrals = len(user.get('referrals', []))
+        is_premium = user.is_premium
+        premium_until = user.premium_until
+        referrals = user.referral_count
         
         text = f"""
 👤 User Information 👤
@@ -503,10 +2944,10 @@ async def user_info(update: Update, context: CallbackContext) -> None:
 *User ID:* `{target_id}`
 *Status:* {'Premium 🎯' if is_premium else 'Free ⭐'}
 *Premium Until:* {premium_until if premium_until else 'Not premium'}
-*Total Cleaned:* {user.get('total_cleaned', 0)}
+*Total Cleaned:* {user.total_cleaned}
 *Referrals:* {referrals}
-*Join Date:* {user.get('join_date', 'Unknown')}
-*Last Used:* {user.get('last_used', 'Never')}
+*Join Date:* {user.join_date or 'Unknown'}
+*Last Used:* {user.last_used or 'Never'}
 """
         
         await update.message.reply_text(text, parse_mode='Markdown')
@@ -527,33 +2968,130 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
     
     try:
         message = ' '.join(context.args)
-        all_users = users_collection.find()
-        success = 0
-        failed = 0
-        
-        await update.message.reply_text("📢 Starting broadcast...")
-        
-        for user in all_users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user['user_id'],
-                    text=f"📢 Admin Broadcast:\n\n{message}",
-                    parse_mode='Markdown'
-                )
-                success += 1
-            except:
-                failed += 1
-        
-        await update.message.reply_text(
-            f"✅ Broadcast completed!\n"
-            f"• Success: {success}\n"
-            f"• Failed: {failed}"
-        )
+        # Runs in the background so this handler returns immediately
+        await broadcasts.start_job(context.bot, message, update.effective_chat.id)
         
     except Exception as e:
         logger.error(f"Error in broadcast: {e}")
         await update.message.reply_text("❌ Error in broadcast.")
 
+async def broadcast_status(update: Update, context: CallbackContext) -> None:
+    """Admin command to show progress of running broadcasts"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+    
+    jobs = broadcasts.running()
+    if not jobs:
+        await update.message.reply_text("No broadcast is running.")
+        return
+    
+    await update.message.reply_text('\n\n'.join(broadcasts.progress_text(job) for job in jobs))
+
+async def cache_stats(update: Update, context: CallbackContext) -> None:
+    """Admin command to inspect in-process caches"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+    
+    users = user_repo.cache.stats()
+    urls = expansion_cache.stats()
+    flight = expansion_flight.stats()
+    
+    text = f"""
+🗄 Cache Stats 🗄
+
+*User Cache:* {users['size']} profiles, {users['memory_bytes'] / 1024:.1f} KB
+• Hit ratio: {users['hit_ratio']:.1%} ({users['hits']} hits / {users['misses']} misses)
+• Evictions: {users['evictions']}
+
+*URL Cache:* {urls['size']} entries
+• Hit ratio: {urls['hit_ratio']:.1%} ({urls['persistent_hits']} from Mongo)
+• Evictions: {urls['evictions']}, Expired: {urls['expirations']}
+
+*Coalesced Expansions:* {flight['coalesced']} ({flight['inflight']} in flight)
+*Buffered Counter Updates:* {user_repo.counters.pending_users()}
+"""
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def queue_stats(update: Update, context: CallbackContext) -> None:
+    """Admin command to show update processing load"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+    
+    queue = update_processor.stats()
+    text = f"""
+⚙️ Update Processing ⚙️
+
+*Concurrency Cap:* {queue['cap']}
+*Active:* {queue['active']}
+*Queued:* {queue['queued']}
+*Processed:* {queue['processed']}
+*Wait:* avg {queue['wait_avg_ms']:.1f} ms, p95 {queue['wait_p95_ms']:.1f} ms, max {queue['wait_max_ms']:.1f} ms
+
+*Expansion Queues:*
+"""
+    for name, cls in expansion_scheduler.stats().items():
+        text += (
+            f"• {name}: {cls['active']} active, {cls['queued']} queued, "
+            f"{cls['completed']} done, {cls['shed']} shed, wait {cls['wait_avg_ms']:.1f} ms\n"
+        )
+    
+    open_circuits = host_guards.open_circuits()
+    text += f"\n*Open Circuits:* {', '.join(open_circuits) if open_circuits else 'none'}\n"
+    slowest = host_guards.slowest()
+    if slowest:
+        text += "*Slowest Hosts:* " + ', '.join(f"{g.host} {g.latency * 1000:.0f} ms" for g in slowest) + "\n"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def profile(update: Update, context: CallbackContext) -> None:
+    """Admin command to toggle the sampling profiler"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+    
+    if not profiler.running:
+        seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+        seconds = max(1, min(seconds, PROFILER_MAX_SECONDS))
+        profiler.start()
+        context.application.create_task(_stop_profiler_after(context.bot, update.effective_chat.id, seconds))
+        await update.message.reply_text(
+            f"🔬 Profiler started for {seconds}s. Send /profile again to stop it early."
+        )
+        return
+    
+    await _send_profile(context.bot, update.effective_chat.id)
+
+async def _stop_profiler_after(bot, chat_id, seconds):
+    started_at = profiler.started_at
+    await asyncio.sleep(seconds)
+    # Only stop the run we started, not one toggled off and on again meanwhile
+    if profiler.running and profiler.started_at == started_at:
+        await _send_profile(bot, chat_id)
+
+async def _send_profile(bot, chat_id):
+    elapsed = time.monotonic() - profiler.started_at
+    samples = await asyncio.to_thread(profiler.stop)
+    total = sum(samples.values())
+    if not total:
+        await bot.send_message(chat_id=chat_id, text="🔬 Profiler stopped. No samples were collected.")
+        return
+    lines = [f"🔬 Profile: {total} samples over {elapsed:.0f}s", "", "Top functions (on-CPU share):"]
+    lines += [f"• {share:.1%} {name}" for name, share in SamplingProfiler.top_functions(samples)]
+    await bot.send_message(chat_id=chat_id, text='\n'.join(lines))
+    try:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=SamplingProfiler.folded(samples).encode(),
+            filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+            caption="Folded stacks - open with speedscope.app or flamegraph.pl"
+        )
+    except TelegramError as e:
+        logger.error(f"Error sending profile: {e}")
+
 async def admin_help(update: Update, context: CallbackContext) -> None:
     """Show admin help"""
     if not is_admin(update.effective_user.id):
@@ -566,35 +3104,317 @@ async def admin_help(update: Update, context: CallbackContext) -> None:
 <code>/make_premium</code> <i>user_id days</i> - Make user premium
 <code>/userinfo</code> <i>user_id</i> - Get user information
 <code>/broadcast</code> <i>message</i> - Broadcast to all users
+<code>/broadcaststatus</code> - Show progress of running broadcasts
 <code>/stats</code> - View user statistics with admin info
+<code>/cachestats</code> - View cache hit ratios and memory use
+<code>/queuestats</code> - View update concurrency and wait times
+<code>/profile</code> <i>[seconds]</i> - Toggle the sampling profiler
 
 <i>Only admins can use these commands!</i>
 """
     
     await update.message.reply_text(text, parse_mode='HTML')
 
+async def on_startup(application) -> None:
+    """Start background workers once the event loop is running"""
+    user_repo.counters.start()
+    daily_quota.buckets.start()
+    admin_metrics.start()
+    loop_lag.start()
+    if METRICS_PORT and BOT_MODE != 'webhook':
+        # Webhook mode serves /metrics from its own server
+        application.bot_data['metrics_runner'] = await start_metrics_server()
+    asyncio.create_task(user_repo.migrate_referrals())
+    await broadcasts.resume_all(application.bot)
+
+async def on_shutdown(application) -> None:
+    """Drain buffered writes and release network resources"""
+    await broadcasts.stop()
+    await bulk_cleaner.stop()
+    await loop_lag.stop()
+    if profiler.running:
+        profiler.stop()
+    if 'metrics_runner' in application.bot_data:
+        await application.bot_data.pop('metrics_runner').cleanup()
+    await admin_metrics.stop()
+    await user_repo.counters.stop()
+    await daily_quota.buckets.stop()
+    await close_http_session()
+
+# ==================== UPDATE PROCESSING ====================
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently up to a cap, keeping each user's updates in order"""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, wait_samples=1000):
+        # The base semaphore is taken before our per-user lock, so it must never be the
+        # bottleneck; the real cap is applied once a user's turn has come. _cap is only set
+        # afterwards because the base class sizes its semaphore from max_concurrent_updates.
+        super().__init__(2 ** 31 - 1)
+        self._cap = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+        self._waits = deque(maxlen=wait_samples)
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.max_wait = 0.0
+
+    @property
+    def max_concurrent_updates(self):
+        return getattr(self, '_cap', self._max_concurrent_updates)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        key = user.id if user else None
+        queued = time.monotonic()
+        lock = self._acquire_user_lock(key)
+        self.waiting += 1
+        started = locked = False
+        try:
+            if lock is not None:
+                await lock.acquire()
+                locked = True
+            try:
+                async with self._slots:
+                    wait = time.monotonic() - queued
+                    self.waiting -= 1
+                    started = True
+                    self._waits.append(wait)
+                    self.max_wait = max(self.max_wait, wait)
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+            finally:
+                if locked:
+                    lock.release()
+        finally:
+            if not started:
+                self.waiting -= 1
+            self._release_user_lock(key)
+
+    def _acquire_user_lock(self, key):
+        """Per-user lock, reference counted so idle users don't accumulate locks"""
+        if key is None:
+            return None
+        lock, refs = self._user_locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._user_locks[key] = (lock, refs + 1)
+        return lock
+
+    def _release_user_lock(self, key):
+        if key is None:
+            return
+        lock, refs = self._user_locks[key]
+        if refs <= 1:
+            del self._user_locks[key]
+        else:
+            self._user_locks[key] = (lock, refs - 1)
+
+    def stats(self):
+        waits = sorted(self._waits)
+        return {
+            'cap': self._cap,
+            'active': self.active,
+            'queued': self.waiting,
+            'processed': self.processed,
+            'wait_avg_ms': sum(waits) / len(waits) * 1000 if waits else 0.0,
+            'wait_p95_ms': waits[int((len(waits) - 1) * 0.95)] * 1000 if waits else 0.0,
+            'wait_max_ms': self.max_wait * 1000
+        }
+
+update_processor = UserOrderedUpdateProcessor()
+# ===========================================================
+
+# ==================== METRICS ENDPOINT ====================
+@metrics.collector
+def runtime_stats():
+    """Existing in-process stats, reported as gauges"""
+    samples = [
+        ('bot_event_loop_lag_last_seconds', 'Most recent event loop lag sample', {}, loop_lag.last_lag),
+        ('bot_profiler_running', 'Whether the sampling profiler is on', {}, int(profiler.running)),
+        ('bot_open_circuits', 'Hosts whose circuit breaker is open', {}, len(host_guards.open_circuits())),
+        ('bot_counter_buffer_pending', 'Users with counter updates not yet flushed', {}, user_repo.counters.pending_users())
+    ]
+    for key, value in update_processor.stats().items():
+        samples.append((f'bot_updates_{key}', 'Update processing stats', {}, value))
+    for name, cache in (('expansion', expansion_cache.stats()), ('user', user_repo.cache.stats())):
+        for key, value in cache.items():
+            samples.append((f'bot_cache_{key}', 'Cache stats', {'cache': name}, value))
+    for name, cls in expansion_scheduler.stats().items():
+        for key, value in cls.items():
+            samples.append((f'bot_expansion_queue_{key}', 'Expansion scheduler stats per priority class', {'class': name}, value))
+    return samples
+
+async def metrics_handler(request):
+    """Prometheus text exposition of everything in the metrics registry"""
+    if METRICS_TOKEN:
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(token, METRICS_TOKEN):
+            return web.Response(status=403)
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_metrics_server(port=METRICS_PORT, host=WEBHOOK_HOST):
+    """Serve /metrics on its own port for polling mode; returns the runner to clean up"""
+    server = web.Application()
+    server.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics listening on {host}:{port}/metrics")
+    return runner
+# ==========================================================
+
+# ==================== WEBHOOK SERVER ====================
+def build_webhook_app(application, secret):
+    """aiohttp app that feeds Telegram updates into the application's queue"""
+    async def receive_update(request):
+        # Anyone can reach this port, so only Telegram's secret header proves an update is real
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        # Queue and acknowledge immediately; handlers run on the application's own loop
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def healthz(request):
+        return web.json_response({
+            'status': 'ok',
+            'running': application.running,
+            'update_queue': application.update_queue.qsize()
+        })
+
+    server = web.Application()
+    server.router.add_post(f'/{WEBHOOK_PATH}', receive_update)
+    server.router.add_get('/healthz', healthz)
+    # This port is public, so metrics are only exposed behind a token
+    if METRICS_TOKEN:
+        server.router.add_get('/metrics', metrics_handler)
+    else:
+        logger.warning("METRICS_TOKEN is not set; /metrics is disabled on the webhook server")
+    return server
+
+async def serve_webhook(application, stop_event, host=WEBHOOK_HOST, port=PORT):
+    """Run the application behind the embedded webhook server until stop_event is set"""
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_SECRET is required when the webhook is registered outside the bot")
+        # Handed to Telegram by set_webhook below, so nobody else can post updates
+        secret = secrets.token_urlsafe(32)
+    runner = web.AppRunner(build_webhook_app(application, secret))
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+        logger.info(f"Webhook server listening on {host}:{port}/{WEBHOOK_PATH}")
+        try:
+            await stop_event.wait()
+        finally:
+            # Stop accepting updates first, then let queued ones finish
+            await runner.cleanup()
+            await application.stop()
+            await on_shutdown(application)
+
+def run_webhook(application):
+    async def runner():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        await serve_webhook(application, stop_event)
+
+    asyncio.run(runner())
+# ========================================================
+
+def build_application():
+    """Create the Application with all handlers registered"""
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .concurrent_updates(update_processor)
+        # One Bot API connection per concurrent handler so replies don't queue on the pool
+        .connection_pool_size(MAX_CONCURRENT_UPDATES)
+        .pool_timeout(10.0)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # Add handlers
+    application.add_handler(CommandHandler("start", timed(start)))
+    application.add_handler(CommandHandler("clean", timed(clean_url)))
+    application.add_handler(CommandHandler("premium", timed(premium_info)))
+    application.add_handler(CommandHandler("stats", timed(stats)))
+    application.add_handler(CommandHandler("referral", timed(referral_info)))
+    application.add_handler(CommandHandler("pay", timed(pay)))
+    application.add_handler(CommandHandler("make_premium", timed(make_premium)))
+    application.add_handler(CommandHandler("userinfo", timed(user_info)))
+    application.add_handler(CommandHandler("broadcast", timed(broadcast)))
+    application.add_handler(CommandHandler("broadcaststatus", timed(broadcast_status)))
+    application.add_handler(CommandHandler("cachestats", timed(cache_stats)))
+    application.add_handler(CommandHandler("queuestats", timed(queue_stats)))
+    application.add_handler(CommandHandler("profile", timed(profile)))
+    application.add_handler(CommandHandler("admin", timed(admin_help)))
+    application.add_handler(CallbackQueryHandler(timed(button_handler)))
+    # Needs inline mode (/setinline) and, for quota accounting, /setinlinefeedback in BotFather
+    application.add_handler(InlineQueryHandler(timed(inline_clean)))
+    application.add_handler(ChosenInlineResultHandler(timed(inline_chosen)))
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & ~filters.COMMAND & (
+            filters.Entity(MessageEntity.URL) | filters.Entity(MessageEntity.TEXT_LINK)
+            | filters.CaptionEntity(MessageEntity.URL) | filters.CaptionEntity(MessageEntity.TEXT_LINK)
+        ),
+        timed(clean_message)
+    ))
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & (
+            filters.Document.FileExtension('txt') | filters.Document.FileExtension('csv')
+        ),
+        timed(clean_document)
+    ))
+    return application
+
 def main() -> None:
     if not TELEGRAM_TOKEN:
         logger.error("No Telegram token found!")
         return
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = build_application()
+    expansion_cache.ensure_indexes()
+    user_repo.ensure_indexes()
+    daily_quota.ensure_indexes()
     
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("clean", clean_url))
-    application.add_handler(CommandHandler("premium", premium_info))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("referral", referral_info))
-    application.add_handler(CommandHandler("pay", pay))
-    application.add_handler(CommandHandler("make_premium", make_premium))
-    application.add_handler(CommandHandler("userinfo", user_info))
-    application.add_handler(CommandHandler("broadcast", broadcast))
-    application.add_handler(CommandHandler("admin", admin_help))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    logger.info("Starting Ads Cleaner Bot...")
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_SECRET and not WEBHOOK_URL:
+            logger.error("Webhook mode needs WEBHOOK_SECRET, or WEBHOOK_URL so a secret can be registered")
+            return
+        run_webhook(application)
+        return
     
     # Start polling
-    logger.info("Starting Ads Cleaner Bot...")
     application.run_polling(
         poll_interval=1.0,
         timeout=30,
@@ -602,4 +3422,4 @@ def main() -> None:
     )
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,235 @@
+"""Local stand-in for the Telegram Bot API, for exercising the bot without network access.
+
+Run directly to post fake updates to the bot's webhook server and measure the
+time from delivering an update to the bot's reply arriving back here:
+
+    python fake_telegram.py --updates 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+FAKE_TOKEN = '123456:LOCAL-FAKE-TOKEN'
+FAKE_WEBHOOK_SECRET = 'local-fake-webhook-secret'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Ads Cleaner', 'username': 'ads_cleaner_bot'}
+
+class FakeBotAPI:
+    """Answers Bot API methods locally and records every reply the bot sends"""
+
+    def __init__(self, host='127.0.0.1', port=8081, delay=0.0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self._waiters = {}
+        self._updates = deque()
+        self._has_updates = asyncio.Event()
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}/bot'
+
+    def wait_for_reply(self, chat_id):
+        """Future resolved with the arrival time of the next message sent to chat_id"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    def inject(self, update):
+        """Queue an update for the bot's next getUpdates poll"""
+        self._updates.append(update)
+        self._has_updates.set()
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        # Updates below the offset have been confirmed by the poller
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, int(params.get('limit') or 100)))
+
+    async def _params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        received = time.perf_counter()
+        if method != 'getUpdates':
+            self.calls.append((method, params, received))
+        if self.delay and method != 'getUpdates':
+            # Simulated round trip to Telegram's servers
+            await asyncio.sleep(self.delay)
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': BOT_USER})
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            waiters = self._waiters.get(chat_id)
+            # Skip waiters that gave up; the reply goes to the oldest one still waiting
+            while waiters:
+                future = waiters.pop(0)
+                if not future.done():
+                    future.set_result(received)
+                    break
+            return web.json_response({'ok': True, 'result': {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }})
+        return web.json_response({'ok': True, 'result': True})
+
+    async def start(self):
+        server = web.Application()
+        server.router.add_post('/bot{token}/{method}', self._handle)
+        server.router.add_get('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(server)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+_update_ids = itertools.count(1)
+
+def make_message_update(user_id, text):
+    """Update dict for a private message, with the entities Telegram would attach to the text"""
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+        'text': text
+    }
+    entities = []
+    if text.startswith('/'):
+        entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+    offset = 0
+    for word in text.split(' '):
+        if word.startswith(('http://', 'https://')):
+            entities.append({'type': 'url', 'offset': offset, 'length': len(word)})
+        offset += len(word) + 1
+    if entities:
+        message['entities'] = entities
+    return {'update_id': next(_update_ids), 'message': message}
+
+def make_callback_update(user_id, data):
+    """Update dict for an inline keyboard button press"""
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': str(user_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'data': data,
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'menu'
+            }
+        }
+    }
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def measure_webhook(updates, concurrency, text, api_port, webhook_port, api_delay=0.0,
+                          mongo_uri='mongomock://'):
+    # The bot reads these at import time; never let a measurement run touch the database in .env
+    os.environ['MONGODB_URI'] = mongo_uri
+    os.environ['TELEGRAM_TOKEN'] = FAKE_TOKEN
+    os.environ['WEBHOOK_SECRET'] = FAKE_WEBHOOK_SECRET
+    import bot
+
+    api = FakeBotAPI(port=api_port, delay=api_delay)
+    await api.start()
+    bot.TELEGRAM_API_URL = api.base_url
+    bot.WEBHOOK_URL = None
+    application = bot.build_application()
+
+    stop_event = asyncio.Event()
+    server = asyncio.create_task(bot.serve_webhook(application, stop_event, '127.0.0.1', webhook_port))
+    url = f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': FAKE_WEBHOOK_SECRET}
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        for _ in range(50):
+            try:
+                async with session.get(f'http://127.0.0.1:{webhook_port}/healthz') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+
+        async def deliver(user_id):
+            async with semaphore:
+                reply = api.wait_for_reply(user_id)
+                started = time.perf_counter()
+                async with session.post(url, json=make_message_update(user_id, text), headers=headers) as response:
+                    response.raise_for_status()
+                latencies.append((await asyncio.wait_for(reply, 30) - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(deliver(1_000_000 + i) for i in range(updates)))
+        elapsed = time.perf_counter() - started
+
+    stop_event.set()
+    await server
+    await api.stop()
+    return {
+        'updates': updates,
+        'concurrency': concurrency,
+        'throughput_per_s': updates / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--text', default='/premium', help='message text to send (default: /premium)')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8088)
+    parser.add_argument('--api-delay', type=float, default=0.0, help='simulated Bot API latency in seconds')
+    parser.add_argument('--mongo-uri', default='mongomock://', help='Mongo to use (default: in-memory mongomock)')
+    args = parser.parse_args()
+    result = asyncio.run(measure_webhook(
+        args.updates, args.concurrency, args.text, args.api_port, args.webhook_port, args.api_delay,
+        args.mongo_uri
+    ))
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
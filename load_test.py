@@ -0,0 +1,247 @@
+"""End-to-end load test of the bot against a fake Bot API server and an in-memory Mongo.
+
+The Application built by bot.build_application() runs unchanged, polling the
+fake server in fake_telegram.py (or fed through the webhook server with
+--mode webhook), while Mongo is swapped for mongomock. A mix of /start, /clean,
+/stats and callback queries from many users is injected at each concurrency
+level and the time until each reply reaches the fake server is recorded:
+
+    python load_test.py --levels 1,5,10,25,50,100 --updates 300 --api-delay 0.05
+
+The JSON result has one point per level (throughput plus reply latency
+percentiles), which is the throughput/latency curve; a table is also printed
+to stderr. --farm makes part of the /clean traffic use short links resolved
+against the local redirect farm from benchmark.py.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+import aiohttp
+
+from fake_telegram import (
+    FAKE_TOKEN, FAKE_WEBHOOK_SECRET, FakeBotAPI, make_callback_update, make_message_update, percentile
+)
+
+DEFAULT_MIX = 'start=0.1,clean=0.6,stats=0.15,callback=0.15'
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {'start', 'clean', 'stats', 'callback'}
+    if unknown:
+        raise ValueError(f"unknown update kinds: {', '.join(sorted(unknown))}")
+    return mix
+
+class Workload:
+    """Random but reproducible stream of (kind, user_id, update) tuples"""
+
+    def __init__(self, mix, users, seed, urls, farm=None, short_ratio=0.0, short_pool=1000):
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.users = users
+        self.rng = random.Random(seed)
+        self.urls = urls
+        self.farm = farm
+        self.short_ratio = short_ratio
+        self.short_pool = short_pool
+
+    def clean_target(self):
+        if self.farm is not None and self.rng.random() < self.short_ratio:
+            i = self.rng.randrange(self.short_pool)
+            return self.farm.url(i, f'/r/302/{self.farm.hops}/{i}')
+        return self.rng.choice(self.urls)
+
+    def next(self):
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        user_id = 2_000_000 + self.rng.randrange(self.users)
+        if kind == 'callback':
+            return kind, user_id, make_callback_update(user_id, 'premium_benefits')
+        text = f'/clean {self.clean_target()}' if kind == 'clean' else f'/{kind}'
+        return kind, user_id, make_message_update(user_id, text)
+
+async def run_level(concurrency, updates, workload, api, send, reply_timeout):
+    """Closed loop: concurrency senders each wait for a reply before sending the next update"""
+    latencies = []
+    by_kind = {}
+    timeouts = 0
+    remaining = iter(range(updates))
+
+    async def sender():
+        nonlocal timeouts
+        for _ in remaining:
+            kind, user_id, update = workload.next()
+            reply = api.wait_for_reply(user_id)
+            started = time.perf_counter()
+            await send(update)
+            try:
+                arrived = await asyncio.wait_for(reply, reply_timeout)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                continue
+            latency = (arrived - started) * 1000
+            latencies.append(latency)
+            by_kind.setdefault(kind, []).append(latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        'updates': updates,
+        'elapsed_s': elapsed,
+        'throughput_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'timeouts': timeouts,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies, default=0.0)
+        },
+        'p95_ms_by_kind': {kind: percentile(values, 95) for kind, values in sorted(by_kind.items())}
+    }
+
+async def run_load_test(args):
+    # Imported here so the environment set up in main() is what the bot sees at import time
+    import bot
+    from benchmark import REALISTIC_URLS, RedirectFarm
+
+    api = FakeBotAPI(port=args.api_port, delay=args.api_delay)
+    await api.start()
+    bot.TELEGRAM_API_URL = api.base_url
+    bot.WEBHOOK_URL = None
+    farm = None
+    if args.farm:
+        farm = RedirectFarm(port=args.farm_port)
+        await farm.start()
+        bot.SHORTENER_HOSTS.update(farm.addresses)
+    workload = Workload(
+        parse_mix(args.mix), args.users, args.seed, REALISTIC_URLS,
+        farm=farm, short_ratio=args.short_ratio
+    )
+
+    application = bot.build_application()
+    bot.expansion_cache.ensure_indexes()
+    bot.user_repo.ensure_indexes()
+    bot.daily_quota.ensure_indexes()
+    stop_event = asyncio.Event()
+    session = aiohttp.ClientSession()
+
+    if args.mode == 'webhook':
+        server = asyncio.create_task(bot.serve_webhook(application, stop_event, '127.0.0.1', args.webhook_port))
+        url = f'http://127.0.0.1:{args.webhook_port}/{bot.WEBHOOK_PATH}'
+        headers = {'X-Telegram-Bot-Api-Secret-Token': FAKE_WEBHOOK_SECRET}
+        for _ in range(50):
+            try:
+                async with session.get(f'http://127.0.0.1:{args.webhook_port}/healthz') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+
+        async def send(update):
+            async with session.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+    else:
+        await application.initialize()
+        await bot.on_startup(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+
+        async def send(update):
+            api.inject(update)
+
+    levels = []
+    try:
+        for concurrency in args.levels:
+            level = await run_level(concurrency, args.updates, workload, api, send, args.reply_timeout)
+            level['update_queue'] = bot.update_processor.stats()
+            levels.append(level)
+            print(
+                f"{concurrency:>6} {level['throughput_per_s']:>10.1f}/s "
+                f"p50 {level['latency_ms']['p50']:>8.1f} ms  p95 {level['latency_ms']['p95']:>8.1f} ms  "
+                f"p99 {level['latency_ms']['p99']:>8.1f} ms  timeouts {level['timeouts']}",
+                file=sys.stderr
+            )
+    finally:
+        await session.close()
+        if args.mode == 'webhook':
+            stop_event.set()
+            await server
+        else:
+            await application.updater.stop()
+            await application.stop()
+            await bot.on_shutdown(application)
+            await application.shutdown()
+        if farm is not None:
+            await farm.stop()
+        await api.stop()
+
+    # The highest level that still meets the latency objective is the sizing answer
+    within_slo = [level for level in levels if level['latency_ms']['p95'] <= args.slo_ms and not level['timeouts']]
+    best = max(within_slo, key=lambda level: level['throughput_per_s'], default=None)
+    return {
+        'config': {
+            'mode': args.mode, 'mix': parse_mix(args.mix), 'users': args.users, 'updates_per_level': args.updates,
+            'api_delay_s': args.api_delay, 'mongo': args.mongo_uri.split('://')[0],
+            'max_concurrent_updates': bot.MAX_CONCURRENT_UPDATES, 'farm': args.farm,
+            'short_ratio': args.short_ratio if args.farm else 0.0, 'slo_p95_ms': args.slo_ms
+        },
+        'levels': levels,
+        'max_within_slo': {
+            'concurrency': best['concurrency'],
+            'throughput_per_s': best['throughput_per_s']
+        } if best else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', default='1,5,10,25,50', help='comma-separated concurrency levels')
+    parser.add_argument('--updates', type=int, default=200, help='updates per level')
+    parser.add_argument('--users', type=int, default=500, help='distinct simulated users')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'update kind weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--api-delay', type=float, default=0.05, help='simulated Bot API latency in seconds')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8088)
+    parser.add_argument('--farm', action='store_true', help='send part of /clean traffic as short links to the redirect farm')
+    parser.add_argument('--farm-port', type=int, default=8090)
+    parser.add_argument('--short-ratio', type=float, default=0.2, help='share of /clean links that need expansion with --farm')
+    parser.add_argument('--reply-timeout', type=float, default=30.0)
+    parser.add_argument('--slo-ms', type=float, default=1000.0, help='p95 reply latency objective')
+    parser.add_argument('--mongo-uri', default='mongomock://', help='Mongo to use (default: in-memory mongomock)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON result to this file')
+    args = parser.parse_args()
+    args.levels = [int(level) for level in args.levels.split(',') if level.strip()]
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Never let a load test write to the production database configured in .env
+    os.environ['MONGODB_URI'] = args.mongo_uri
+    os.environ['TELEGRAM_TOKEN'] = FAKE_TOKEN
+    os.environ['WEBHOOK_SECRET'] = FAKE_WEBHOOK_SECRET
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    logging.getLogger('bot').setLevel(logging.WARNING)
+
+    result = asyncio.run(run_load_test(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Never let importing the bot reach the database configured in .env
+os.environ['MONGODB_URI'] = 'mongomock://'
+
+import bot
+
+def update_from(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+class UserOrderedUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_base_semaphore_is_not_the_cap(self):
+        processor = bot.UserOrderedUpdateProcessor(4)
+        self.assertEqual(processor.max_concurrent_updates, 4)
+        self.assertGreater(processor._semaphore._value, 4)
+
+    async def test_one_users_backlog_does_not_block_another_user(self):
+        processor = bot.UserOrderedUpdateProcessor(4)
+        order = []
+
+        async def slow(i):
+            await asyncio.sleep(0.2)
+            order.append(i)
+
+        backlog = [
+            asyncio.create_task(processor.process_update(update_from(1), slow(i)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        await processor.process_update(update_from(2), asyncio.sleep(0))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        await asyncio.gather(*backlog)
+        self.assertEqual(order, list(range(6)))
+
+if __name__ == '__main__':
+    unittest.main()